@@ -0,0 +1,50 @@
+from os import cpu_count
+from multiprocessing import Pool
+
+
+def n_processes(n_jobs : int) -> int:
+    """
+    Return how many processes n_jobs asks for: n_jobs itself if positive,
+    else counting back from the number of cores as joblib does, -1 meaning
+    all of them, -2 all but one and so on, but always at least one.
+    """
+    if n_jobs is None or n_jobs == 0:
+        return 1
+    if n_jobs < 0:
+        return max(cpu_count() + 1 + n_jobs, 1)
+    return n_jobs
+
+
+def pool_imap(func, items, state=None, n_jobs : int = 1):
+    """
+    Yield func(state, item) for each of items, in order. With n_jobs other
+    than 1 (see n_processes()) the calls are made in a pool of worker
+    processes, no more than there are items if items has a length. Each
+    worker gets state, such as a shadow tree and the training data it holds,
+    once when it starts rather than with every item, so func and state must
+    be picklable (func a module-level function, not a lambda). Results are
+    yielded as they come, so they needn't all be held at once; the pool
+    shuts down when the generator is exhausted or closed.
+    """
+    n = n_processes(n_jobs)
+    if hasattr(items, '__len__'):
+        n = min(n, len(items))
+    if n <= 1:
+        for item in items:
+            yield func(state, item)
+        return
+    with Pool(n, initializer=_init_worker, initargs=(func, state)) as pool:
+        yield from pool.imap(_call_in_worker, items)
+
+
+_worker_func = None # set in each pool_imap() worker process
+_worker_state = None
+
+
+def _init_worker(func, state):
+    global _worker_func, _worker_state
+    _worker_func, _worker_state = func, state
+
+
+def _call_in_worker(item):
+    return _worker_func(_worker_state, item)
@@ -1,16 +1,16 @@
-import IPython, graphviz, re
-from io import StringIO
-from IPython.display import Image
+# Keep imports to what walking a tree needs: serving processes import this
+# module just to explain predictions. pandas and scipy are only touched when
+# the data is in them or a function needs them; see testing/bench.py --check-imports.
+import sys
+import warnings
 import numpy as np
-import pandas as pd
-import math
-from sklearn import tree
-from sklearn.datasets import load_boston, load_iris
-from collections import defaultdict, Sequence
-import string
-import re
+from collections.abc import Sequence, Iterator
 from typing import Mapping, List, Tuple
 from numbers import Number
+from animl.parallel import pool_imap
+
+
+CHUNK_SIZE = 1 << 18 # rows of training data per ShadowDecTree.scan() chunk
 
 
 class ShadowDecTree:
@@ -21,14 +21,41 @@ class ShadowDecTree:
     package.
 
     This tree shadows a decision tree as constructed by scikit-learn's
-    DecisionTree(Regressor|Classifier).  As part of build process, the
-    samples considered at each decision node or at each leaf node are
-    saved as a big dictionary for use by the nodes.
+    DecisionTree(Regressor|Classifier).  The samples considered at each
+    decision node or at each leaf node are found when first asked for. Those
+    of a single node, samples_of(), come from partitioning its parent's
+    samples on the parent's split, going up only as far as the nearest node
+    already done, and are cached. Statistics over all nodes at once only
+    need the leaf each sample lands in, leaf_samples(). Any use of the
+    fields below calls build_samples() to find the samples of every node in
+    one pass and keep them as one compact int32 buffer of sample indexes,
+    sample_index, plus per-node offsets, sample_offsets. The samples of
+    node i are then sample_index[sample_offsets[i]:sample_offsets[i+1]].
+    Building a shadow tree just to walk it, predict or print it doesn't look
+    at the training data at all.
+
+    The tree structure lives in numpy arrays indexed by node id: fields
+    children_left, children_right, parent and depth. Fields leaf_ids and
+    internal_ids list the leaf and non-leaf node ids in the order a
+    left-to-right depth-first walk finishes them. Nothing recurses, so
+    trees thousands of levels deep are fine.
 
-    Field leaves is list of shadow leaf nodes. Field internal is list of
-    shadow non-leaf nodes.
+    Field root is the shadow tree root; fields leaves and internal are lists
+    of shadow leaf and non-leaf nodes. Shadow nodes are lightweight views
+    created on demand from the arrays.
 
-    Field root is the shadow tree root.
+    build_samples() goes chunk_size rows at a time, possibly in n_jobs
+    worker processes, so X_train can be a memory-mapped array (np.memmap,
+    np.load(..., mmap_mode='r')) bigger than memory allows to copy, or an
+    iterator (such as a generator) of row chunks, which are stacked into
+    X_train as they stream in (and run down the tree right away, as they can
+    only be gone through once). Anything else, such as a list of rows, is
+    taken as a matrix.
+
+    The sample index lists take memory proportional to the number of training
+    samples times the tree depth. If that is too much, summarize() computes
+    the per-node statistics the visualizations need without them and drops
+    whatever samples were found.
 
     Parameters
     ----------
@@ -36,12 +63,28 @@ class ShadowDecTree:
                   to target class name. If you pass in a list of strings,
                   target value i must be associated with class name[i]. You
                   can also pass in a dict that maps value to name.
+    chunk_size : int. How many rows of X_train to run down the tree at a
+                 time. Default is CHUNK_SIZE.
+    n_jobs : int. How many processes scan chunks; negative counts back from
+             the number of cores, see animl.parallel.n_processes().
+             Default is 1, scan in this process.
+    node_samples : (np.ndarray, np.ndarray). The (index, offsets) pair
+                   node_samples() would return, if already known; X_train
+                   isn't scanned then. ShadowForest passes slices of the
+                   membership of all its trees.
+    feature_stats : dict. Statistics of X_train and y_train to share with
+                    other shadow trees over the same data, as ShadowForest
+                    does.
     """
     def __init__(self, tree_model,
                  X_train,
                  y_train,
                  feature_names : List[str],
-                 class_names : (List[str],Mapping[int,str])=None):
+                 class_names : (List[str],Mapping[int,str])=None,
+                 chunk_size : int = None,
+                 n_jobs : int = 1,
+                 node_samples : Tuple[np.ndarray, np.ndarray] = None,
+                 feature_stats : dict = None):
         self.tree_model = tree_model
         self.feature_names = feature_names
         self.class_names = class_names
@@ -57,163 +100,884 @@ class ShadowDecTree:
             else:
                 raise Exception(f"class_names must be dict or sequence, not {self.class_names.__class__.__name__}")
 
-        if isinstance(X_train, pd.DataFrame):
-            X_train = X_train.values
+        X_train = _values(X_train)
+        chunks = None
+        if isinstance(X_train, Iterator): # a stream of chunks
+            chunks = []
+            X_train = ShadowDecTree._collect(X_train, chunks)
+        elif not isinstance(X_train, np.ndarray):
+            X_train = np.asarray(X_train)
+        self.y_train = np.asarray(_values(y_train))
+        self.histogram_cache = {} # nbins -> get_split_node_histograms() result
+        # Other per-node statistics over the samples, such as target means,
+        # kept so they survive summarize() dropping the samples
+        self.summary_cache = {}
+        # Per-feature statistics over X_train, filled lazily by feature_range(),
+        # feature_bins() etc... so each column is scanned at most once.
+        self.feature_stats = feature_stats if feature_stats is not None else {}
+        self.chunk_size = chunk_size # for build_samples()
+        self.n_jobs = n_jobs
+        self.node_sample_cache = {} # node id -> samples, until build_samples()
+        self.summarized = False
+        self._sample_index = self._sample_offsets = self._sample_counts = None
+        self._leaf_samples = None # see leaf_samples()
+        if node_samples is not None:
+            self._sample_index, self._sample_offsets = node_samples
+        elif chunks is not None:
+            self._set_samples(*ShadowDecTree.scan(tree_model, X_train, chunk_size=chunk_size, n_jobs=n_jobs))
+            X_train = np.concatenate(chunks)
+            del chunks
         self.X_train = X_train
-        if isinstance(y_train, pd.Series):
-            y_train = y_train.values
-        self.y_train = y_train
-        self.unique_target_values = np.unique(y_train)
-        self.node_to_samples = ShadowDecTree.node_samples(tree_model, X_train)
 
+        # Grab the arrays from the sklearn tree once; going through tree_ for
+        # every node access is a chain of lookups into the Cython object.
         tree = tree_model.tree_
-        children_left = tree.children_left
-        children_right = tree.children_right
-
-        # use locals not args to walk() for recursion speed in python
-        leaves = []
-        internal = [] # non-leaf nodes
-
-        def walk(node_id):
-            if (children_left[node_id] == -1 and children_right[node_id] == -1):  # leaf
-                t = ShadowDecTreeNode(self, node_id)
-                leaves.append(t)
-                return t
-            else:  # decision node
-                left = walk(children_left[node_id])
-                right = walk(children_right[node_id])
-                t = ShadowDecTreeNode(self, node_id, left, right)
-                internal.append(t)
-                return t
-
-        root_node_id = 0
-        # record root to actual shadow nodes
-        self.root = walk(root_node_id)
-        self.leaves = leaves
-        self.internal = internal
+        self.children_left = tree.children_left
+        self.children_right = tree.children_right
+        self.feature = tree.feature
+        self.threshold = tree.threshold
+        self.value = tree.value
+        self.n_node_samples = tree.n_node_samples
+        self.impurity = tree.impurity
+        self.n_classes = tree.n_classes
+        self.parent, self.depth, self.leaf_ids, self.internal_ids = \
+            ShadowDecTree.tree_structure(self.children_left, self.children_right)
+
+    @property
+    def root(self) -> 'ShadowDecTreeNode':
+        return ShadowDecTreeNode(self, 0)
+
+    @property
+    def unique_target_values(self) -> np.ndarray:
+        "Return the sorted distinct values of y_train"
+        key = ('target_values',)
+        if key not in self.feature_stats:
+            self.feature_stats[key] = np.unique(self.y_train)
+        return self.feature_stats[key]
+
+    @property
+    def leaves(self) -> List['ShadowDecTreeNode']:
+        return [ShadowDecTreeNode(self, i) for i in self.leaf_ids.tolist()]
+
+    @property
+    def internal(self) -> List['ShadowDecTreeNode']:
+        return [ShadowDecTreeNode(self, i) for i in self.internal_ids.tolist()]
 
     def nclasses(self):
-        return self.tree_model.tree_.n_classes[0]
+        return self.n_classes[0]
 
     def nnodes(self) -> int:
         "Return total nodes in the tree"
-        return self.tree_model.tree_.node_count
+        return len(self.children_left)
+
+    def leaf_sample_counts(self) -> np.ndarray:
+        "Return number of samples in each leaf, in leaves order"
+        return self.sample_counts[self.leaf_ids]
+
+    def leaf_predictions(self) -> np.ndarray:
+        "Return predicted class or value of each leaf, in leaves order"
+        return self.node_predictions(self.leaf_ids)
 
-    def leaf_sample_counts(self) -> List[int]:
-        return [self.tree_model.tree_.n_node_samples[leaf.id] for leaf in self.leaves]
+    def split_thresholds(self) -> np.ndarray:
+        "Return split value of each decision node, in internal order"
+        return self.threshold[self.internal_ids]
+
+    def split_features(self) -> np.ndarray:
+        "Return feature index tested by each decision node, in internal order"
+        return self.feature[self.internal_ids]
+
+    def node_predictions(self, node_ids) -> np.ndarray:
+        """
+        Return the class (for classifiers) or value (for regressors) that the
+        tree predicts at each node in node_ids.
+        """
+        values = self.value[node_ids][:, 0, :]
+        if self.isclassifier():
+            return np.argmax(values, axis=1)
+        return values[:, 0]
 
     def isclassifier(self):
-        return self.tree_model.tree_.n_classes > 1
+        return self.n_classes > 1
+
+    def subtree_sizes(self) -> np.ndarray:
+        "Return the number of nodes in the subtree under each node, itself included, indexed by node id"
+        sizes = np.ones(self.nnodes(), dtype=np.int64)
+        internal_ids = self.internal_ids
+        depths = self.depth[internal_ids]
+        # deepest level first so children are complete before their parents
+        for d in range(int(depths.max()) if len(depths) else -1, -1, -1):
+            ids = internal_ids[depths == d]
+            sizes[ids] += sizes[self.children_left[ids]] + sizes[self.children_right[ids]]
+        return sizes
+
+    def window(self, root_id : int = 0, depth : int = None) \
+            -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Return (internal_ids, leaf_ids, truncated_ids) for the part of the tree
+        within depth levels below node root_id (all of its subtree if depth
+        is None). Decision nodes at the last level are truncated: they are in
+        the window but their children aren't. Each array is in the post-order
+        of internal_ids and leaf_ids.
+        """
+        if not 0 <= root_id < self.nnodes():
+            raise ValueError(f"root_id {root_id} is not a node of the tree")
+        if depth is not None and depth < 0:
+            raise ValueError(f"depth must be >= 0, not {depth}")
+        inwindow = np.zeros(self.nnodes(), dtype=bool)
+        level = np.array([root_id])
+        d = 0
+        while len(level) > 0 and (depth is None or d <= depth):
+            inwindow[level] = True
+            level = level[self.children_left[level] != -1]
+            level = np.concatenate([self.children_left[level], self.children_right[level]])
+            d += 1
+        internal_ids = self.internal_ids[inwindow[self.internal_ids]]
+        truncated = np.zeros(len(internal_ids), dtype=bool)
+        if depth is not None:
+            truncated = self.depth[internal_ids] - self.depth[root_id] == depth
+        return internal_ids[~truncated], self.leaf_ids[inwindow[self.leaf_ids]], internal_ids[truncated]
+
+    def get_split_node_heights(self, X_train=None, y_train=None, nbins=None) -> Mapping[int,int]:
+        """
+        Return a dictionary mapping decision node id to the height of the
+        tallest (all classes stacked) bar in that node's histogram.
+
+        X_train and y_train are deprecated and ignored; the histograms are of
+        the shadow tree's own training data. Pass nbins by keyword.
+        """
+        if X_train is not None or y_train is not None:
+            warnings.warn("get_split_node_heights() uses the shadow tree's own X_train and y_train; "
+                          "drop those arguments and pass only nbins",
+                          DeprecationWarning, stacklevel=2)
+        if nbins is None:
+            raise TypeError("get_split_node_heights() missing argument nbins")
+        histograms = self.get_split_node_histograms(nbins)
+        return {node_id: np.max(np.sum(hist, axis=1)) for node_id, hist in histograms.items()}
+
+    def get_split_node_histograms(self, nbins) -> Mapping[int,np.ndarray]:
+        """
+        Return a dictionary mapping decision node id to an (nbins, nclasses)
+        array counting the node's training samples of each class (in
+        unique_target_values order) that fall in each bin of the node's
+        split feature. Bins are feature_bins(feature, nbins).
+
+        All decision nodes are done together: every training value is
+        assigned a (bin, class) cell once per feature and then
+        node_bincounts() counts the cells of all nodes splitting on that
+        feature at once. Results are kept, per nbins, for the life of the
+        shadow tree.
+        """
+        if nbins in self.histogram_cache:
+            return self.histogram_cache[nbins]
 
-    def get_split_node_heights(self, X_train, y_train, nbins) -> Mapping[int,int]:
         class_values = self.unique_target_values
-        node_heights = {}
-        # print(f"Goal {nbins} bins")
-        for node in self.internal:
-            # print(node.feature_name(), node.id)
-            X_feature = X_train[:, node.feature()]
-            overall_feature_range = (np.min(X_feature), np.max(X_feature))
-            # print(f"range {overall_feature_range}")
-            r = overall_feature_range[1] - overall_feature_range[0]
-            binwidth = r / nbins
-            bins = np.linspace(overall_feature_range[0],
-                               overall_feature_range[1], nbins+1)
-            # bins = np.arange(overall_feature_range[0],
-            #                  overall_feature_range[1] + binwidth, binwidth)
-            # print(f"\tlen(bins)={len(bins):2d} bins={bins}")
-            X, y = X_feature[node.samples()], y_train[node.samples()]
-            X_hist = [X[y == cl] for cl in class_values]
-            height_of_bins = np.zeros(nbins)
-            for cl in class_values:
-                hist, foo = np.histogram(X_hist[cl], bins=bins, range=overall_feature_range)
-                # print(f"class {cl}: goal_n={len(bins):2d} n={len(hist):2d} {hist}")
-                height_of_bins += hist
-            node_heights[node.id] = np.max(height_of_bins)
-
-            # print(f"\tmax={np.max(height_of_bins):2.0f}, heights={list(height_of_bins)}, {len(height_of_bins)} bins")
-        return node_heights
+        nclasses = len(class_values)
+        ncells = nbins * nclasses
+        y_class = np.searchsorted(class_values, self.y_train)
+
+        histograms = {}
+        internal_ids = self.internal_ids
+        features = self.feature[internal_ids]
+        for feature in np.unique(features):
+            node_ids = internal_ids[features == feature]
+            bins = self.feature_bins(feature, nbins)
+            # same bin as np.histogram: [a,b) except last bin is [a,b]
+            bin_of = np.searchsorted(bins, self.X_train[:, feature], side='right') - 1
+            cell_of = np.clip(bin_of, 0, nbins - 1) * nclasses + y_class
+            counts = self.node_bincounts(node_ids, cell_of, ncells)
+            counts = counts.reshape(len(node_ids), nbins, nclasses)
+            for i, node_id in enumerate(node_ids.tolist()):
+                histograms[node_id] = counts[i]
+
+        self.histogram_cache[nbins] = histograms
+        return histograms
+
+    def get_split_node_densities(self, bins, y_range) -> Mapping[int,np.ndarray]:
+        """
+        Return a dictionary mapping each decision node id to a bins[1] x bins[0]
+        matrix counting the node's training samples in each cell of a grid
+        with bins[0] columns evenly spanning the range of its split feature and
+        bins[1] rows evenly spanning y_range of the target, y running down the
+        rows. Samples outside the grid count toward the nearest edge cell. As
+        with get_split_node_histograms(), every sample is assigned a cell once
+        per feature and one node_bincounts() covers all nodes splitting on it.
+        """
+        key = ('densities', tuple(bins), tuple(y_range))
+        if key in self.summary_cache:
+            return self.summary_cache[key]
+
+        nx, ny = bins
+        ncells = nx * ny
+        y_cell = _grid_cell(self.y_train, y_range, ny)
+
+        densities = {}
+        internal_ids = self.internal_ids
+        features = self.feature[internal_ids]
+        for feature in np.unique(features):
+            node_ids = internal_ids[features == feature]
+            cell_of = y_cell * nx + _grid_cell(self.X_train[:, feature], self.feature_range(feature), nx)
+            counts = self.node_bincounts(node_ids, cell_of, ncells)
+            counts = counts.reshape(len(node_ids), ny, nx)
+            for i, node_id in enumerate(node_ids.tolist()):
+                densities[node_id] = counts[i]
+
+        self.summary_cache[key] = densities
+        return densities
+
+    def node_target_means(self) -> np.ndarray:
+        "Return the mean target value of each node's training samples, indexed by node id"
+        key = ('means',)
+        if key not in self.summary_cache:
+            sums = self.node_bincounts(np.arange(self.nnodes()), np.zeros(len(self.y_train), dtype=np.intp), 1,
+                                       weights=self.y_train)
+            self.summary_cache[key] = sums[:, 0] / self.sample_counts
+        return self.summary_cache[key]
+
+    def leaf_target_quantiles(self, q) -> Mapping[int,np.ndarray]:
+        """
+        Return a dictionary mapping each leaf id to the q quantiles (fractions
+        in [0,1]) of the target values of its training samples, linearly
+        interpolated like np.quantile's default. One sort orders the samples
+        of all leaves at once.
+        """
+        q = np.atleast_1d(q)
+        key = ('quantiles', tuple(q))
+        if key in self.summary_cache:
+            return self.summary_cache[key]
+
+        segment, samples = self.node_sample_segments(self.leaf_ids)
+        y = self.y_train[samples]
+        y = y[np.lexsort((y, segment))]
+        lengths = self.sample_counts[self.leaf_ids]
+        starts = np.cumsum(lengths) - lengths
+        positions = q[None, :] * np.maximum(lengths[:, None] - 1, 0)
+        lo = np.floor(positions).astype(np.int64)
+        hi = np.ceil(positions).astype(np.int64)
+        y = np.append(y, np.nan) # so leaves without samples index something
+        below, above = y[starts[:, None] + lo], y[starts[:, None] + hi]
+        quantiles = below + (above - below) * (positions - lo)
+        quantiles[lengths == 0] = np.nan
+
+        result = {node_id: quantiles[i] for i, node_id in enumerate(self.leaf_ids.tolist())}
+        self.summary_cache[key] = result
+        return result
+
+    def summarize(self, histogram_bins=(), density_bins=None, y_range=None, quantiles=()):
+        """
+        Compute the per-node summary statistics that the visualizations use in
+        place of samples, then drop the sample index lists to save memory. For
+        classifiers these are get_split_node_histograms() for each nbins in
+        histogram_bins. For regressors, node_target_means(),
+        get_split_node_densities(density_bins, y_range), if density_bins is
+        given, and leaf_target_quantiles(quantiles). Afterwards, asking for
+        samples or for statistics not computed here raises ValueError.
+
+        Unless build_samples() has already run, the statistics are gathered
+        from leaf_samples(), so the per-node sample lists are never made and
+        memory stays proportional to the number of samples, not samples
+        times depth.
+        """
+        if self.isclassifier():
+            for nbins in histogram_bins:
+                self.get_split_node_histograms(nbins)
+        else:
+            self.node_target_means()
+            if density_bins is not None:
+                self.get_split_node_densities(density_bins, y_range)
+            if len(quantiles):
+                self.leaf_target_quantiles(quantiles)
+        self.sample_counts # keep the counts
+        self._sample_index = self._sample_offsets = self._leaf_samples = None
+        self.node_sample_cache.clear()
+        self.summarized = True
+
+    def has_samples(self) -> bool:
+        "Return whether node samples can be had, which they can unless summarize() dropped them"
+        return not self.summarized
+
+    def build_samples(self):
+        """
+        Find the samples of every node in one pass over X_train, see scan(),
+        unless already done. Afterwards, samples_of() returns views into
+        sample_index.
+        """
+        if self._sample_index is not None:
+            return
+        if not self.has_samples():
+            raise ValueError("samples were dropped by summarize()")
+        self._set_samples(*ShadowDecTree.scan(self.tree_model, self.X_train,
+                                              chunk_size=self.chunk_size, n_jobs=self.n_jobs))
+        self.node_sample_cache.clear()
+
+    def _set_samples(self, index, offsets, feature_min, feature_max):
+        self._sample_index, self._sample_offsets = index, offsets
+        for feature in range(len(feature_min)): # free while we had the chunks at hand
+            self.feature_stats[('range', feature)] = (feature_min[feature], feature_max[feature])
+
+    @property
+    def sample_index(self) -> np.ndarray:
+        self.build_samples()
+        return self._sample_index
+
+    @property
+    def sample_offsets(self) -> np.ndarray:
+        self.build_samples()
+        return self._sample_offsets
+
+    @property
+    def sample_counts(self) -> np.ndarray:
+        """
+        Return the number of samples in each node, indexed by node id. Unlike
+        the tree's n_node_samples, these are counts of X_train, which needn't
+        be the data the model was fit to.
+        """
+        if self._sample_counts is None:
+            if self._sample_index is not None:
+                self._sample_counts = np.diff(self._sample_offsets)
+            else:
+                _, starts, stops = self.leaf_samples()
+                self._sample_counts = stops - starts
+        return self._sample_counts
+
+    def samples_of(self, node_id) -> np.ndarray:
+        """
+        Return the sorted sample indexes of node node_id; see ShadowDecTreeNode.samples().
+        Before build_samples(), the samples are found by partitioning those
+        of the node's nearest ancestor with known samples (all of X_train at
+        the root) down the path to the node, caching both sides of every split.
+        """
+        if not self.has_samples():
+            raise ValueError("samples were dropped by summarize()")
+        if self._sample_index is not None:
+            offsets = self._sample_offsets
+            return self._sample_index[offsets[node_id]:offsets[node_id+1]]
+
+        cache = self.node_sample_cache
+        path = []
+        while node_id not in cache and node_id != 0:
+            path.append(node_id)
+            node_id = int(self.parent[node_id])
+        if node_id not in cache:
+            cache[0] = np.arange(len(self.X_train), dtype=np.int32)
+        samples = cache[node_id]
+        for child in reversed(path):
+            parent = self.parent[child]
+            # The test decision_path() does: the float32 value <= the threshold
+            values = self.X_train[samples, self.feature[parent]].astype(np.float32)
+            goleft = values.astype(np.float64) <= self.threshold[parent]
+            cache[int(self.children_left[parent])] = samples[goleft]
+            cache[int(self.children_right[parent])] = samples[~goleft]
+            samples = cache[child]
+        return samples
+
+    def nsamples_of(self, node_id) -> int:
+        "Return len(samples_of(node_id)) without building all samples if they aren't yet"
+        if self._sample_counts is None and self._sample_index is None:
+            return len(self.samples_of(node_id))
+        return self.sample_counts[node_id]
+
+    def feature_range(self, feature) -> Tuple[Number, Number]:
+        "Return (min, max) of feature over X_train"
+        key = ('range', feature)
+        if key not in self.feature_stats:
+            X_feature = self.X_train[:, feature]
+            self.feature_stats[key] = (np.min(X_feature), np.max(X_feature))
+        return self.feature_stats[key]
+
+    def feature_bins(self, feature, nbins) -> np.ndarray:
+        "Return nbins+1 bin edges evenly spanning the range of feature in X_train"
+        key = ('bins', feature, nbins)
+        if key not in self.feature_stats:
+            self.feature_stats[key] = np.linspace(*self.feature_range(feature), nbins + 1)
+        return self.feature_stats[key]
+
+    def feature_order(self, feature) -> np.ndarray:
+        "Return the sample indexes that sort feature in X_train (stable argsort)"
+        key = ('order', feature)
+        if key not in self.feature_stats:
+            self.feature_stats[key] = np.argsort(self.X_train[:, feature], kind='stable')
+        return self.feature_stats[key]
+
+    def feature_quantiles(self, feature, q) -> np.ndarray:
+        """
+        Return the q quantiles (fractions in [0,1]) of feature in X_train,
+        linearly interpolated like np.quantile's default, computed from
+        feature_order().
+        """
+        q = np.atleast_1d(q)
+        key = ('quantiles', feature, tuple(q))
+        if key not in self.feature_stats:
+            sorted_feature = self.X_train[self.feature_order(feature), feature]
+            positions = q * (len(sorted_feature) - 1)
+            self.feature_stats[key] = np.interp(positions, np.arange(len(sorted_feature)), sorted_feature)
+        return self.feature_stats[key]
+
+    def leaf_samples(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Return (index, starts, stops): the sample indexes of X_train ordered
+        by the leaf they land in, leaves in leaf_ids order, and for every
+        node, indexed by node id, where its samples are in index. leaf_ids
+        is in post-order, so the leaves under a node are a run of it and the
+        samples of node i are index[starts[i]:stops[i]], sorted within each
+        leaf. Only the leaf of each sample is found, with the model's
+        apply() chunk_size rows at a time; that is one int32 per sample where
+        build_samples() keeps one per sample per level.
+        """
+        if not self.has_samples():
+            raise ValueError("samples were dropped by summarize()")
+        if self._leaf_samples is None:
+            chunk_size = self.chunk_size or CHUNK_SIZE
+            leaf_position = np.empty(self.nnodes(), dtype=np.int32)
+            leaf_position[self.leaf_ids] = np.arange(len(self.leaf_ids))
+            position = np.empty(len(self.X_train), dtype=np.int32)
+            for start in range(0, len(self.X_train), chunk_size):
+                leaves = self.tree_model.apply(self.X_train[start:start + chunk_size])
+                position[start:start + chunk_size] = leaf_position[leaves]
+            index = np.argsort(position, kind='stable').astype(np.int32)
+            leaf_offsets = np.zeros(len(self.leaf_ids) + 1, dtype=np.int64)
+            leaf_offsets[1:] = np.cumsum(np.bincount(position, minlength=len(self.leaf_ids)))
+            del position
+
+            # first and last leaf under each node, deepest level first so
+            # children are done before their parents
+            first = np.zeros(self.nnodes(), dtype=np.int64)
+            first[self.leaf_ids] = leaf_position[self.leaf_ids]
+            last = first.copy()
+            internal_ids = self.internal_ids
+            depths = self.depth[internal_ids]
+            for d in range(int(depths.max()) if len(depths) else -1, -1, -1):
+                ids = internal_ids[depths == d]
+                first[ids] = first[self.children_left[ids]]
+                last[ids] = last[self.children_right[ids]]
+            self._leaf_samples = (index, leaf_offsets[first], leaf_offsets[last + 1])
+        return self._leaf_samples
+
+    def node_bincounts(self, node_ids, cell_of, ncells, weights=None) -> np.ndarray:
+        """
+        Return a (len(node_ids), ncells) array counting the samples of each
+        node in node_ids in each cell, cell_of[i] being the cell of sample i,
+        or summing weights[i] instead of counting if weights is given. Nodes
+        go a tree level at a time, one bincount over their concatenated
+        samples (see node_sample_segments()) per level. Nodes on a level have
+        no samples in common, so that is at most one index per sample.
+        """
+        node_ids = np.asarray(node_ids)
+        counts = np.zeros((len(node_ids), ncells), dtype=np.int64 if weights is None else np.float64)
+        depths = self.depth[node_ids]
+        for d in np.unique(depths):
+            rows = np.nonzero(depths == d)[0]
+            segment, samples = self.node_sample_segments(node_ids[rows])
+            level = np.bincount(segment * ncells + cell_of[samples],
+                                weights=None if weights is None else weights[samples],
+                                minlength=len(rows) * ncells)
+            counts[rows] = level.reshape(len(rows), ncells)
+        return counts
+
+    def node_sample_segments(self, node_ids) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Return (segment, samples) where samples concatenates the sample
+        indexes of the nodes in node_ids and segment[j] is the position
+        within node_ids of the node that samples[j] came from. The samples
+        come from sample_index if built, else from leaf_samples(), so each
+        node's may not be in increasing order.
+        """
+        if not self.has_samples():
+            raise ValueError("samples were dropped by summarize()")
+        node_ids = np.asarray(node_ids)
+        if self._sample_index is not None:
+            index = self._sample_index
+            starts = self._sample_offsets[node_ids]
+            lengths = self._sample_offsets[node_ids + 1] - starts
+        else:
+            index, node_starts, node_stops = self.leaf_samples()
+            starts = node_starts[node_ids]
+            lengths = node_stops[node_ids] - starts
+        segment = np.repeat(np.arange(len(node_ids)), lengths)
+        ends = np.cumsum(lengths)
+        positions = np.arange(ends[-1] if len(ends) else 0) + np.repeat(starts - (ends - lengths), lengths)
+        return segment, index[positions]
 
     def predict(self, x : np.ndarray) -> Tuple[Number,List]:
         """
         Given an x-vector of features, return predicted class or value based upon
         this tree. Also return path from root to leaf as 2nd value in return tuple.
-        Recursively walk down tree from root to appropriate leaf by
-        comparing feature in x to node's split value. Also return
+        Walk down tree from root to appropriate leaf by comparing feature in x
+        to node's split value.
 
         :param x: Feature vector to run down the tree to a leaf.
         :type x: np.ndarray
         :return: Predicted class or value based
         :rtype: Number
         """
-        def walk(t, x, path):
-            if t is None:
-                return None
+        path = []
+        t = self.root
+        while True:
             path.append(t)
             if t.isleaf():
-                return t
+                break
             if x[t.feature()] < t.split():
-                return walk(t.left, x, path)
-            return walk(t.right, x, path)
+                t = t.left
+            else:
+                t = t.right
+        return t.prediction(), path
 
-        path = []
-        leaf = walk(self.root, x, path)
-        return leaf.prediction(), path
+    def predict_batch(self, X : np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Given a matrix X of feature vectors, one per row, return a tuple
+        (predictions, leaf_ids, paths) for all rows at once. predictions holds
+        the predicted class or value for each row, leaf_ids the id of the leaf
+        each row lands in and paths is a padded (len(X), max path length) int
+        array with the node ids from root to leaf for each row; entries past
+        a row's leaf are -1.
+
+        Results match predict() row for row, including its use of
+        x[feature] < split to go left. Rather than recursing per row, all
+        unfinished rows step down one level at a time using the tree's own
+        arrays.
+
+        :param X: Matrix (or data frame) of feature vectors to run down the tree.
+        :type X: np.ndarray
+        :return: predictions, leaf ids and decision paths as numpy arrays
+        """
+        X = np.atleast_2d(_values(X))
+        children_left = self.children_left
+        children_right = self.children_right
+        feature = self.feature
+        threshold = self.threshold
+        isleaf = (children_left == -1) & (children_right == -1)
+
+        n = len(X)
+        node = np.zeros(n, dtype=np.intp)
+        steps = [node.copy()]
+        active = np.nonzero(~isleaf[node])[0] # rows not yet at a leaf
+        while len(active) > 0:
+            cur = node[active]
+            goleft = X[active, feature[cur]] < threshold[cur]
+            node[active] = np.where(goleft, children_left[cur], children_right[cur])
+            step = np.full(n, -1, dtype=np.intp)
+            step[active] = node[active]
+            steps.append(step)
+            active = active[~isleaf[node[active]]]
+        paths = np.column_stack(steps)
+        return self.node_predictions(node), node, paths
+
+    @staticmethod
+    def node_samples(tree_model, data, chunk_size : int = None, n_jobs : int = 1) \
+            -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Return the sample indexes considered by the feature/split decision
+        of every node as a pair (index, offsets) of numpy arrays. The
+        samples of node i are index[offsets[i]:offsets[i+1]], in
+        increasing order. See scan().
+        """
+        index, offsets, _, _ = ShadowDecTree.scan(tree_model, data, chunk_size, n_jobs)
+        return index, offsets
+
+    @staticmethod
+    def scan(tree_model, data, chunk_size : int = None, n_jobs : int = 1) \
+            -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Run data, a matrix or an iterator of row chunks, down the tree and
+        return (index, offsets, feature_min, feature_max): the node samples
+        as for node_samples() plus the min and max of each feature (column).
+
+        Rather than walking the indicator matrix sample by sample, flip it
+        from sample-major (CSR) to node-major (CSC) order. That is a single
+        pass linear in the number of nonzeros and leaves the node to sample
+        mapping as one int32 buffer plus per-node offsets.
+
+        That is done chunk_size rows at a time so that neither sklearn's
+        float32 copy of the input nor the indicator matrix is ever made for
+        all of data at once. With n_jobs other than 1, chunks are scanned in
+        a pool of worker processes (see animl.parallel.n_processes());
+        workers get array data when they start rather than with each chunk,
+        which for a memory-mapped array on platforms that fork costs nothing. Chunks are
+        then merged in order, node by node.
+        """
+        if chunk_size is None:
+            chunk_size = CHUNK_SIZE
+        if isinstance(data, Iterator):
+            jobs = ShadowDecTree._starts(data)
+            data = None
+        else:
+            if not isinstance(data, np.ndarray): # keep memory maps as they are
+                data = np.asarray(data)
+            jobs = [(start, None) for start in range(0, len(data), chunk_size)]
+        chunks = list(pool_imap(_scan_chunk, jobs, (tree_model, data, chunk_size), n_jobs))
+
+        nnodes = _node_count(tree_model)
+        if len(chunks) == 0:
+            return np.zeros(0, dtype=np.int32), np.zeros(nnodes + 1, dtype=np.int64), \
+                   np.zeros(0), np.zeros(0)
+        counts = np.array([c for _, c, _, _ in chunks]) # (chunk, node) -> sample count
+        feature_min = np.min([m for _, _, m, _ in chunks], axis=0)
+        feature_max = np.max([m for _, _, _, m in chunks], axis=0)
+        offsets = np.zeros(nnodes + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(counts.sum(axis=0))
+        index = np.empty(offsets[-1], dtype=np.int32)
+        base = offsets[:-1].copy() # where each node's next chunk goes
+        for i in range(len(chunks)):
+            chunk_index, chunk_counts, _, _ = chunks[i]
+            chunks[i] = None
+            chunk_starts = np.cumsum(chunk_counts) - chunk_counts
+            positions = np.repeat(base - chunk_starts, chunk_counts) + np.arange(len(chunk_index))
+            index[positions] = chunk_index
+            base += chunk_counts
+        return index, offsets, feature_min, feature_max
+
+    @staticmethod
+    def _starts(chunks):
+        "Yield (start row, chunk) for each chunk of rows in iterable chunks"
+        start = 0
+        for chunk in chunks:
+            yield start, chunk
+            start += len(chunk)
+
+    @staticmethod
+    def _collect(chunks, collected):
+        "Yield the chunks of rows in iterable chunks as arrays, appending them to list collected"
+        for chunk in chunks:
+            chunk = np.asarray(_values(chunk))
+            collected.append(chunk)
+            yield chunk
 
     @staticmethod
-    def node_samples(tree_model, data) -> Mapping[int, list]:
+    def tree_structure(children_left, children_right) \
+            -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
         """
-        Return dictionary mapping node id to list of sample indexes considered by
-        the feature/split decision.
+        Return (parent, depth, leaf_ids, internal_ids) arrays for the tree
+        described by the children_left, children_right arrays of a
+        scikit-learn tree. The root's parent is -1. leaf_ids and internal_ids
+        are in the order a recursive left-to-right walk would finish the nodes
+        (post-order) but are computed with an explicit stack.
         """
-        # Doc say: "Return a node indicator matrix where non zero elements
-        #           indicates that the samples goes through the nodes."
-        dec_paths = tree_model.decision_path(data)
+        nnodes = len(children_left)
+        isleaf = (children_left == -1) & (children_right == -1)
+        ids = np.nonzero(~isleaf)[0]
+        parent = np.full(nnodes, -1, dtype=np.int64)
+        parent[children_left[ids]] = ids
+        parent[children_right[ids]] = ids
 
-        # each sample has path taken down tree
-        node_to_samples = defaultdict(list)
-        for sample_i, dec in enumerate(dec_paths):
-            _, nz_nodes = dec.nonzero()
-            for node_id in nz_nodes:
-                node_to_samples[node_id].append(sample_i)
+        # depth one level at a time
+        depth = np.zeros(nnodes, dtype=np.int64)
+        level = np.array([0])
+        d = 0
+        while len(level) > 0:
+            depth[level] = d
+            level = level[~isleaf[level]]
+            level = np.concatenate([children_left[level], children_right[level]])
+            d += 1
 
-        return node_to_samples
+        # Popping a node then pushing left, right gives node, right subtree,
+        # left subtree. Reversed, that is left, right, node: post-order.
+        left = children_left.tolist()
+        right = children_right.tolist()
+        order = []
+        stack = [0]
+        while stack:
+            node_id = stack.pop()
+            order.append(node_id)
+            if left[node_id] != -1:
+                stack.append(left[node_id])
+                stack.append(right[node_id])
+        order = np.array(order[::-1], dtype=np.int64)
+        return parent, depth, order[isleaf[order]], order[~isleaf[order]]
 
     def __str__(self):
         return str(self.root)
 
 
+class ShadowForest:
+    """
+    Shadow trees for all estimators of a scikit-learn ensemble of decision
+    trees, such as RandomForest(Regressor|Classifier), ExtraTrees* or
+    GradientBoosting*, found in one pass over the training data.
+
+    Each chunk of training rows is converted to float32 once and run down
+    every tree, giving one indicator matrix whose node columns come tree
+    after tree, tree i's nodes starting at column n_nodes_ptr[i], like a
+    forest's decision_path() (which boosting lacks). As for ShadowDecTree,
+    that becomes the membership of every node of every tree in one
+    node-major sample_index buffer; each shadow tree gets a slice of it
+    without copying. See ShadowDecTree.scan() for chunk_size and n_jobs.
+
+    The shadow trees, in field trees (in estimators_ order, flattened for
+    boosting's 2-D array of trees), share X_train, y_train and one
+    feature_stats dict, so statistics like feature ranges are found once for
+    the forest. Use map() to work on trees in parallel.
+    """
+    def __init__(self, forest_model,
+                 X_train,
+                 y_train,
+                 feature_names : List[str],
+                 class_names : (List[str],Mapping[int,str])=None,
+                 chunk_size : int = None,
+                 n_jobs : int = 1):
+        self.forest_model = forest_model
+        self.estimators = list(np.ravel(forest_model.estimators_))
+        self.feature_names = feature_names
+
+        # Convert once here rather than in each tree's ShadowDecTree()
+        X_train = _values(X_train)
+        if not isinstance(X_train, np.ndarray): # keep memory maps as they are
+            X_train = np.asarray(X_train)
+        self.X_train = X_train
+        self.y_train = y_train = np.asarray(_values(y_train))
+
+        if chunk_size is None: # keep a chunk's indicator matrix about as big as for one tree
+            chunk_size = max(CHUNK_SIZE // len(self.estimators), 1024)
+        self.sample_index, offsets, feature_min, feature_max = \
+            ShadowDecTree.scan(self.estimators, X_train, chunk_size=chunk_size, n_jobs=n_jobs)
+        self.n_nodes_ptr = np.cumsum([0] + [e.tree_.node_count for e in self.estimators])
+
+        self.feature_stats = {}
+        for feature in range(len(feature_min)):
+            self.feature_stats[('range', feature)] = (feature_min[feature], feature_max[feature])
+
+        self.trees = []
+        for i, estimator in enumerate(self.estimators):
+            start, stop = self.n_nodes_ptr[i], self.n_nodes_ptr[i+1]
+            tree_offsets = offsets[start:stop+1]
+            tree_index = self.sample_index[tree_offsets[0]:tree_offsets[-1]]
+            self.trees.append(ShadowDecTree(estimator, X_train, y_train,
+                                            feature_names=feature_names, class_names=class_names,
+                                            node_samples=(tree_index, tree_offsets - tree_offsets[0]),
+                                            feature_stats=self.feature_stats))
+
+    def __len__(self):
+        return len(self.trees)
+
+    def __getitem__(self, i) -> ShadowDecTree:
+        return self.trees[i]
+
+    def map(self, func, n_jobs : int = 1) -> list:
+        """
+        Return [func(tree) for tree in self.trees], computed in a pool of
+        n_jobs worker processes (see animl.parallel.n_processes()) if n_jobs
+        isn't 1.
+        Workers get the forest, and the training data it holds, once when
+        they start, not with every tree, and func must be picklable (a
+        module-level function, not a lambda), e.g. one that calls
+        animl.viz.trees.viz_shadow_tree() to render a tree.
+        """
+        return list(pool_imap(_map_tree, range(len(self.trees)), (self, func), n_jobs))
+
+
+def _map_tree(state, i):
+    forest, func = state
+    return func(forest.trees[i])
+
+
+def _values(data):
+    "Return the numpy array behind a pandas DataFrame or Series, or data itself if it isn't one"
+    # Data can only be pandas if the caller has imported pandas already
+    pd = sys.modules.get('pandas')
+    if pd is not None and isinstance(data, (pd.DataFrame, pd.Series)):
+        return data.values
+    return data
+
+
+def _grid_cell(values, value_range, n) -> np.ndarray:
+    "Return which of n equal cells spanning value_range each of values falls in, clipped to [0, n-1]"
+    lo, hi = value_range
+    if hi <= lo:
+        return np.zeros(len(values), dtype=np.intp)
+    return np.clip(((values - lo) * (n / (hi - lo))).astype(np.intp), 0, n - 1)
+
+
+def _decision_path(model, X):
+    """
+    Return the node indicator matrix of model for X. model is a tree or a
+    list of trees, whose matrices are put side by side like a forest's
+    decision_path() does. Each tree's matrix is flipped to node-major (CSC)
+    order before stacking, which is much faster than flipping the stack.
+    """
+    if isinstance(model, list):
+        import scipy.sparse
+        X = np.ascontiguousarray(X, dtype=np.float32) # convert once, not per tree
+        return scipy.sparse.hstack([m.decision_path(X, check_input=False).tocsc() for m in model],
+                                   format='csc')
+    return model.decision_path(X)
+
+
+def _node_count(model) -> int:
+    "Return how many columns _decision_path() gives for model"
+    if isinstance(model, list):
+        return sum(m.tree_.node_count for m in model)
+    return model.tree_.node_count
+
+
+def _scan_chunk(state, job):
+    """
+    Run one chunk of rows down the tree; state is (tree model, data, chunk
+    size) and job is (start row, chunk), chunk being None to take the rows
+    from data. Return the chunk's node samples as (index, per-node counts)
+    plus per-feature min and max.
+    """
+    tree_model, data, chunk_size = state
+    start, chunk = job
+    if chunk is None:
+        chunk = data[start:start + chunk_size]
+    # Doc say: "Return a node indicator matrix where non zero elements
+    #           indicates that the samples goes through the nodes."
+    dec_paths = _decision_path(tree_model, chunk)
+    # columns are nodes; row indexes within a column come out sorted
+    node_to_samples = dec_paths.tocsc()
+    index = node_to_samples.indices.astype(np.int32) + np.int32(start)
+    counts = np.diff(node_to_samples.indptr)
+    return index, counts, np.min(chunk, axis=0), np.max(chunk, axis=0)
+
+
 class ShadowDecTreeNode:
     """
     A node in a shadow tree.  Each node has left and right
-    pointers to child nodes, if any.  As part of tree construction process, the
-    samples examined at each decision node or at each leaf node are
-    saved into field node_samples.
+    pointers to child nodes, if any.  Nodes are lightweight views onto the
+    arrays held by the shadow tree, created on demand, so two node objects
+    with the same tree and id are equal.
     """
-    def __init__(self, shadow_tree, id, left=None, right=None):
+    __slots__ = ('shadow_tree', 'id')
+
+    def __init__(self, shadow_tree, id):
         self.shadow_tree = shadow_tree
         self.id = id
-        self.left = left
-        self.right = right
+
+    @property
+    def left(self) -> ('ShadowDecTreeNode',None):
+        child = self.shadow_tree.children_left[self.id]
+        return ShadowDecTreeNode(self.shadow_tree, int(child)) if child != -1 else None
+
+    @property
+    def right(self) -> ('ShadowDecTreeNode',None):
+        child = self.shadow_tree.children_right[self.id]
+        return ShadowDecTreeNode(self.shadow_tree, int(child)) if child != -1 else None
+
+    def __eq__(self, other):
+        return isinstance(other, ShadowDecTreeNode) and \
+               other.shadow_tree is self.shadow_tree and other.id == self.id
+
+    def __hash__(self):
+        return hash((id(self.shadow_tree), self.id))
 
     def split(self) -> (int,float):
-        return self.shadow_tree.tree_model.tree_.threshold[self.id]
+        return self.shadow_tree.threshold[self.id]
 
     def feature(self) -> int:
-        return self.shadow_tree.tree_model.tree_.feature[self.id]
+        return self.shadow_tree.feature[self.id]
 
     def feature_name(self) -> (str,None):
         if self.shadow_tree.feature_names is not None:
             return self.shadow_tree.feature_names[ self.feature()]
         return None
 
-    def samples(self) -> List[int]:
+    def samples(self) -> np.ndarray:
         """
-        Return a list of sample indexes associated with this node. If this is a
+        Return an array of sample indexes associated with this node. If this is a
         leaf node, it indicates the samples used to compute the predicted value
         or class.  If this is an internal node, it is the number of samples used
-        to compute the split point.
+        to compute the split point. The array is a view into the shadow tree's
+        sample_index buffer or cached by the shadow tree; don't modify it.
         """
-        return self.shadow_tree.node_to_samples[self.id]
+        return self.shadow_tree.samples_of(self.id)
 
     def nsamples(self) -> int:
         """
@@ -222,13 +986,13 @@ class ShadowDecTreeNode:
         or class. If this is an internal node, it is the number of samples used
         to compute the split point.
         """
-        return self.shadow_tree.tree_model.tree_.n_node_samples[self.id] # same as len(self.node_samples)
+        return self.shadow_tree.nsamples_of(self.id) # same as len(self.samples())
 
     def split_samples(self) -> Tuple[np.ndarray, np.ndarray]:
         """
         Return the list of indexes to the left and the right of the split value.
         """
-        samples = np.array(self.samples())
+        samples = self.samples()
         node_X_data = self.shadow_tree.X_train[samples, self.feature()]
         split = self.split()
         left = np.nonzero(node_X_data < split)[0]
@@ -236,10 +1000,11 @@ class ShadowDecTreeNode:
         return left, right
 
     def isleaf(self) -> bool:
-        return self.left is None and self.right is None
+        return bool(self.shadow_tree.children_left[self.id] == -1 and
+                    self.shadow_tree.children_right[self.id] == -1)
 
     def isclassifier(self):
-        return self.shadow_tree.tree_model.tree_.n_classes > 1
+        return self.shadow_tree.isclassifier()
 
     def prediction(self) -> (Number,None):
         """
@@ -248,11 +1013,11 @@ class ShadowDecTreeNode:
         """
         if not self.isleaf(): return None
         if self.isclassifier():
-            counts = np.array(self.shadow_tree.tree_model.tree_.value[self.id][0])
+            counts = self.shadow_tree.value[self.id][0]
             predicted_class = np.argmax(counts)
             return predicted_class
         else:
-            return self.shadow_tree.tree_model.tree_.value[self.id][0][0]
+            return self.shadow_tree.value[self.id][0][0]
 
     def prediction_name(self) -> (str,None):
         """
@@ -271,20 +1036,37 @@ class ShadowDecTreeNode:
         associated with each class.
         """
         if self.isclassifier():
-            return np.array(self.shadow_tree.tree_model.tree_.value[self.id][0], dtype=int)
+            return np.array(self.shadow_tree.value[self.id][0], dtype=int)
         return None
 
     def __str__(self):
-        if self.left is None and self.right is None:
-            return "<pred={value},n={n}>".format(value=round(self.prediction(),1), n=self.nsamples())
-        else:
-            return "({f}@{s} {left} {right})".format(f=self.feature_name(),
-                                                     s=round(self.split(),1),
-                                                     left=self.left if self.left is not None else '',
-                                                     right=self.right if self.right is not None else '')
+        # Build strings bottom up with an explicit stack rather than recursion
+        # so that very deep trees don't hit Python's recursion limit.
+        text = {}
+        stack = [self]
+        while stack:
+            t = stack[-1]
+            if t.isleaf():
+                # the count the model was fit with, which needs no samples
+                n = t.shadow_tree.n_node_samples[t.id]
+                text[t.id] = "<pred={value},n={n}>".format(value=round(t.prediction(),1), n=n)
+                stack.pop()
+            elif t.left.id in text and t.right.id in text:
+                text[t.id] = "({f}@{s} {left} {right})".format(f=t.feature_name(),
+                                                             s=round(t.split(),1),
+                                                             left=text.pop(t.left.id),
+                                                             right=text.pop(t.right.id))
+                stack.pop()
+            else:
+                stack.extend(child for child in (t.right, t.left) if child.id not in text)
+        return text[self.id]
 
 
 if __name__ == "__main__":
+    import pandas as pd
+    from sklearn import tree
+    from sklearn.datasets import load_boston
+
     regr = tree.DecisionTreeRegressor(max_depth=5, random_state=666)
     boston = load_boston()
 
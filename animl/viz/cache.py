@@ -0,0 +1,157 @@
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from io import StringIO
+import numpy as np
+
+
+class FigureCache:
+    """
+    A content-addressed cache of rendered node figures (SVG text) so that
+    re-rendering the same model, say in another orientation or for another
+    instance X, only redraws the figures that actually changed.
+
+    Keys come from key(), a hash of everything a figure depends on: the
+    values of the node's samples, the feature, styling parameters and
+    highlight state. Entries live in memory up to max_bytes of SVG text,
+    evicting the least recently used first. If directory is given, entries
+    are also written there as {key}.svg, misses in memory are looked up on
+    disk, and the directory is kept under max_disk_bytes by removing the
+    least recently used files (by modification time, which a hit refreshes).
+    A directory can be shared by several processes.
+
+    The cache is safe to use from several threads. When sent to another
+    process (e.g., dtreeviz(n_jobs=...) workers) only the settings go, not
+    the in-memory entries, so workers share entries only via directory.
+    """
+    def __init__(self, directory : str = None,
+                 max_bytes : int = 64 * 1024 * 1024,
+                 max_disk_bytes : int = 1024 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.memory = OrderedDict() # key -> svg, least recently used first
+        self.nbytes = 0
+        self.disk_bytes = None # estimate; found by scanning directory when needed
+        self.lock = threading.Lock()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def __getstate__(self):
+        return {'directory': self.directory,
+                'max_bytes': self.max_bytes,
+                'max_disk_bytes': self.max_disk_bytes}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def __len__(self):
+        return len(self.memory)
+
+    @staticmethod
+    def key(*parts) -> str:
+        """
+        Return a hex digest identifying a figure drawn from parts, which can be
+        numpy arrays (hashed by dtype, shape and content) or anything with a
+        stable repr().
+        """
+        h = hashlib.sha1()
+        for part in parts:
+            if isinstance(part, np.ndarray):
+                h.update(f"{part.dtype}{part.shape}".encode())
+                h.update(np.ascontiguousarray(part).tobytes())
+            else:
+                h.update(repr(part).encode())
+            h.update(b'\0')
+        return h.hexdigest()
+
+    def get(self, key) -> (str, None):
+        "Return the SVG text cached under key or None"
+        with self.lock:
+            svg = self.memory.get(key)
+            if svg is not None:
+                self.memory.move_to_end(key)
+                return svg
+            if self.directory is None:
+                return None
+            filename = os.path.join(self.directory, f"{key}.svg")
+            try:
+                with open(filename) as f:
+                    svg = f.read()
+                os.utime(filename) # mark as recently used
+            except OSError:
+                return None
+            self._remember(key, svg)
+            return svg
+
+    def put(self, key, svg):
+        "Cache SVG text svg under key"
+        with self.lock:
+            self._remember(key, svg)
+            if self.directory is None:
+                return
+            fd, tmpname = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+            with os.fdopen(fd, "w") as f:
+                f.write(svg)
+            os.replace(tmpname, os.path.join(self.directory, f"{key}.svg"))
+            if self.disk_bytes is not None:
+                self.disk_bytes += len(svg)
+            if self.disk_bytes is None or self.disk_bytes > self.max_disk_bytes:
+                self._trim_directory()
+
+    def render(self, key, filename, draw):
+        """
+        Write the figure cached under key to filename, a file name or file
+        object. On a miss, call draw(buffer) to render the figure as SVG into
+        a text buffer and cache it first.
+        """
+        svg = self.get(key)
+        if svg is None:
+            buffer = StringIO()
+            draw(buffer)
+            svg = buffer.getvalue()
+            self.put(key, svg)
+        if hasattr(filename, 'write'):
+            filename.write(svg)
+        else:
+            with open(filename, "w") as f:
+                f.write(svg)
+
+    def clear(self):
+        "Drop all entries from memory and from directory"
+        with self.lock:
+            self.memory.clear()
+            self.nbytes = 0
+            self.disk_bytes = 0
+            if self.directory is not None:
+                for name in os.listdir(self.directory):
+                    if name.endswith(".svg"):
+                        os.remove(os.path.join(self.directory, name))
+
+    def _remember(self, key, svg):
+        if key in self.memory:
+            self.nbytes -= len(self.memory.pop(key))
+        self.memory[key] = svg
+        self.nbytes += len(svg)
+        while self.nbytes > self.max_bytes and len(self.memory) > 1:
+            _, old = self.memory.popitem(last=False)
+            self.nbytes -= len(old)
+
+    def _trim_directory(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".svg"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError: # another process got to it first
+                pass
+            total -= size
+        self.disk_bytes = total
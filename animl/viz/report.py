@@ -0,0 +1,115 @@
+import cProfile
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+from io import StringIO
+
+
+class RenderReport:
+    """
+    Wall times, in seconds, of the stages of making and saving a tree
+    visualization, for finding out where the time goes without patching
+    the library. dtreeviz() and viz_shadow_tree() fill one in and attach it
+    to the returned DTreeViz as field report; DTreeViz.svg() and save() add
+    to it. Stages are recorded in order as (name, seconds, info) in field
+    stages, info being a dict of details such as the number of figures
+    drawn. Stages may nest and, when threads share a DTreeViz, overlap;
+    each is recorded as it ends. The stages are:
+
+        shadow_tree  building the ShadowDecTree (dtreeviz() only)
+        statistics   per-node histograms and, with summarize, the summary
+        figures      drawing node, leaf and legend figures; see nodes
+        dot          generating the DOT
+        layout       graphviz laying out the DOT and drawing it as SVG
+        inline       putting the node figures into graphviz's SVG
+        optimize     optimize_svg()
+        images       writing in-memory figures to files for save()
+        convert      graphviz drawing a format other than SVG in save()
+
+    Node samples are found when first needed, so that time lands in
+    statistics or figures. Field nodes maps each figure's key ("node3",
+    "leaf7", "legend0"...) to the time it took to draw, measured where it
+    was drawn, in a worker process if n_jobs isn't 1; figures reused from a
+    previous visualization aren't in it. Field subprocesses lists
+    (command, seconds) for each graphviz run and field sizes maps outputs
+    ("dot", "figures", "svg" or a saved file name) to their size in bytes.
+
+    If callback is given, it is called as callback(name, seconds, info) as
+    each stage ends, e.g. to feed metrics elsewhere. With profile=True, the
+    stages run under cProfile; see profile_stats(). Figures drawn in worker
+    processes aren't profiled.
+    """
+    def __init__(self, callback=None, profile : bool = False):
+        self.callback = callback
+        self.stages = []
+        self.nodes = {}
+        self.subprocesses = []
+        self.sizes = {}
+        self.profiler = cProfile.Profile() if profile else None
+        self._depth = 0 # stages in progress, profiled while there are any
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # the profiler and callback stay in the process that made the report
+        state = self.__dict__.copy()
+        state['callback'] = state['profiler'] = state['_lock'] = None
+        state['_depth'] = 0
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name, **info):
+        "Time the body of a with statement as stage name"
+        self._profile(1)
+        start = time.perf_counter()
+        try:
+            yield info # the body can add details
+        finally:
+            seconds = time.perf_counter() - start
+            self._profile(-1)
+            self.stages.append((name, seconds, info))
+            if 'command' in info:
+                self.subprocesses.append((info['command'], seconds))
+            if self.callback is not None:
+                self.callback(name, seconds, info)
+
+    def _profile(self, step):
+        "Count a stage starting (step 1) or ending (-1), profiling from the first start to the last end"
+        if self.profiler is None:
+            return
+        with self._lock:
+            self._depth += step
+            if step > 0 and self._depth == 1:
+                self.profiler.enable()
+            elif step < 0 and self._depth == 0:
+                self.profiler.disable()
+
+    def seconds(self, name=None) -> float:
+        "Return the total time of stages called name, or of all stages"
+        return sum(s for n, s, _ in self.stages if name is None or n == name)
+
+    def profile_stats(self, sort='cumulative') -> pstats.Stats:
+        "Return the pstats.Stats of the profiled stages, sorted by sort; requires profile=True"
+        if self.profiler is None:
+            raise ValueError("not profiling; make the report with profile=True")
+        return pstats.Stats(self.profiler, stream=StringIO()).sort_stats(sort)
+
+    def as_dict(self) -> dict:
+        "Return the report as a dictionary of plain values, e.g. to dump as JSON"
+        return {'stages': [dict(info, name=name, seconds=seconds) for name, seconds, info in self.stages],
+                'nodes': dict(self.nodes),
+                'subprocesses': [{'command': command, 'seconds': seconds}
+                                 for command, seconds in self.subprocesses],
+                'sizes': dict(self.sizes)}
+
+    def __str__(self):
+        lines = [f"{name:12s} {seconds:9.3f}s" for name, seconds, _ in self.stages]
+        if self.nodes:
+            slowest = max(self.nodes, key=self.nodes.get)
+            lines.append(f"{len(self.nodes)} figures, slowest {slowest} {self.nodes[slowest]:.3f}s")
+        lines += [f"{name}: {nbytes} bytes" for name, nbytes in self.sizes.items()]
+        return "\n".join(lines)
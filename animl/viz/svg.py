@@ -0,0 +1,255 @@
+import math
+from xml.sax.saxutils import escape
+import numpy as np
+
+# Advance widths, in ems, of DejaVu Sans (matplotlib's default font, which the
+# node figures end up in) for estimating how much room text takes
+_CHAR_WIDTHS = {**{c: .636 for c in "0123456789"},
+                '.': .318, ',': .318, ' ': .318, '-': .361, '−': .838, '=': .838,
+                '(': .390, ')': .390, '_': .500, 'i': .278, 'j': .278, 'l': .278,
+                'f': .352, 't': .392, 'r': .411, 'm': .974, 'w': .818, 'M': .863, 'W': .989}
+_ASCENT, _DESCENT = .76, .24 # of the font's glyphs, in ems
+
+FONT_FAMILY = "DejaVu Sans, Arial, Helvetica, sans-serif"
+
+
+def text_width(s, size) -> float:
+    "Return the approximate width in points of string s in a size point font"
+    return sum(_CHAR_WIDTHS.get(c, .68 if c.isupper() else .6) for c in s) * size
+
+
+def fmt(v) -> str:
+    "Format coordinate v compactly, to hundredths of a point"
+    s = f"{v:.2f}".rstrip('0').rstrip('.')
+    return "0" if s == "-0" else s
+
+
+class SVGFigure:
+    """
+    A figure drawn directly as SVG elements, in points with y going down,
+    for when matplotlib is too slow. Drawing methods take coordinates in
+    points; Axes maps data coordinates to them. The figure tracks the
+    bounding box of everything drawn so that svg() can crop to it, as
+    matplotlib's bbox_inches='tight' does.
+    """
+    def __init__(self):
+        self.elements = []
+        self.x0 = self.y0 = math.inf
+        self.x1 = self.y1 = -math.inf
+
+    def extend(self, x0, y0, x1, y1):
+        "Grow the bounding box to include the rectangle from (x0,y0) to (x1,y1)"
+        self.x0, self.y0 = min(self.x0, x0, x1), min(self.y0, y0, y1)
+        self.x1, self.y1 = max(self.x1, x0, x1), max(self.y1, y0, y1)
+
+    def rect(self, x, y, width, height, fill, stroke=None, stroke_width=None, opacity=None):
+        attrs = _attrs(fill=fill, stroke=stroke, stroke_width=stroke_width, fill_opacity=opacity)
+        self.elements.append(f'<rect x="{fmt(x)}" y="{fmt(y)}" width="{fmt(width)}" height="{fmt(height)}"{attrs}/>')
+        self.extend(x, y, x + width, y + height)
+
+    def rects(self, xs, ys, widths, heights, fill, stroke=None, stroke_width=None, opacity=None):
+        "Draw rectangles of one style, given by arrays of their corners and sizes, as a group"
+        if len(xs) == 0:
+            return
+        attrs = _attrs(fill=fill, stroke=stroke, stroke_width=stroke_width, fill_opacity=opacity)
+        rects = ''.join(f'<rect x="{fmt(x)}" y="{fmt(y)}" width="{fmt(w)}" height="{fmt(h)}"/>'
+                        for x, y, w, h in zip(xs, ys, widths, heights))
+        self.elements.append(f'<g{attrs}>{rects}</g>')
+        self.extend(np.min(xs), np.min(ys), np.max(xs + widths), np.max(ys + heights))
+
+    def line(self, x1, y1, x2, y2, stroke, width=1, dashed=False):
+        dash = f' stroke-dasharray="{fmt(3.7*width)},{fmt(1.6*width)}"' if dashed else ''
+        self.elements.append(f'<line x1="{fmt(x1)}" y1="{fmt(y1)}" x2="{fmt(x2)}" y2="{fmt(y2)}" '
+                             f'stroke="{stroke}" stroke-width="{fmt(width)}"{dash}/>')
+        self.extend(x1, y1, x2, y2)
+
+    def polygon(self, points, fill, stroke=None, stroke_width=None):
+        attrs = _attrs(fill=fill, stroke=stroke, stroke_width=stroke_width)
+        self.elements.append(f'<polygon points="{" ".join(f"{fmt(x)},{fmt(y)}" for x, y in points)}"{attrs}/>')
+        xs, ys = zip(*points)
+        self.extend(min(xs), min(ys), max(xs), max(ys))
+
+    def path(self, d, bbox, fill, stroke=None, stroke_width=None):
+        "Draw SVG path data d, whose bounding box is bbox = (x0, y0, x1, y1)"
+        attrs = _attrs(fill=fill, stroke=stroke, stroke_width=stroke_width)
+        self.elements.append(f'<path d="{d}"{attrs}/>')
+        self.extend(*bbox)
+
+    def circles(self, xs, ys, r, fill, opacity=None, edge_width=None):
+        """
+        Draw circles of radius r centered on each (xs[i], ys[i]) as a group,
+        outlined edge_width wide in the fill color as scatter() markers are
+        """
+        if len(xs) == 0:
+            return
+        circles = ''.join(f'<circle cx="{fmt(x)}" cy="{fmt(y)}" r="{fmt(r)}"/>' for x, y in zip(xs, ys))
+        attrs = _attrs(fill=fill, fill_opacity=opacity)
+        if edge_width is not None:
+            attrs += _attrs(stroke=fill, stroke_width=edge_width, stroke_opacity=opacity)
+            r += edge_width / 2
+        self.elements.append(f'<g{attrs}>{circles}</g>')
+        self.extend(np.min(xs) - r, np.min(ys) - r, np.max(xs) + r, np.max(ys) + r)
+
+    def text(self, x, y, s, size, color, anchor='middle', valign='top', rotate=False):
+        """
+        Draw string s in a size point font. anchor ('start', 'middle' or
+        'end') says where x is along the text; valign ('top', 'center' or
+        'baseline') where y is. With rotate, the text runs bottom to top and
+        x and y are swapped around: anchor is along y, valign along x.
+        """
+        if s == '':
+            return
+        width = text_width(s, size)
+        shift = {'top': _ASCENT * size, 'center': .35 * size, 'baseline': 0}[valign]
+        start = {'start': 0, 'middle': -width / 2, 'end': -width}[anchor]
+        attrs = f' font-family="{FONT_FAMILY}" font-size="{fmt(size)}" fill="{color}"'
+        if anchor != 'start':
+            attrs += f' text-anchor="{anchor}"'
+        if rotate:
+            bx, by = x + shift, y
+            self.elements.append(f'<text transform="translate({fmt(bx)},{fmt(by)}) rotate(-90)"{attrs}>{escape(s)}</text>')
+            self.extend(bx - _ASCENT * size, by - start - width, bx + _DESCENT * size, by - start)
+        else:
+            bx, by = x, y + shift
+            self.elements.append(f'<text x="{fmt(bx)}" y="{fmt(by)}"{attrs}>{escape(s)}</text>')
+            self.extend(bx + start, by - _ASCENT * size, bx + start + width, by + _DESCENT * size)
+
+    def svg(self) -> str:
+        "Return the figure as an SVG document cropped to what was drawn"
+        width, height = self.x1 - self.x0, self.y1 - self.y0
+        return (f'<svg xmlns="http://www.w3.org/2000/svg" version="1.1" '
+                f'width="{fmt(width)}pt" height="{fmt(height)}pt" viewBox="0 0 {fmt(width)} {fmt(height)}">'
+                f'<g transform="translate({fmt(-self.x0)},{fmt(-self.y0)})">'
+                f'{"".join(self.elements)}</g></svg>')
+
+    def save(self, filename):
+        """
+        Write the figure to filename, a file name or file object. If filename
+        is None, return the SVG text instead.
+        """
+        svg = self.svg()
+        if filename is None:
+            return svg
+        if hasattr(filename, 'write'):
+            filename.write(svg)
+        else:
+            with open(filename, "w") as f:
+                f.write(svg)
+
+
+class Axes:
+    """
+    A width x height point plot area of an SVGFigure with its top left
+    corner at (x, y), mapping data coordinates in xlim x ylim to points.
+    The drawing methods mirror the matplotlib Axes calls the node figures
+    make, with matplotlib's default tick sizes and paddings.
+    """
+    TICK_LENGTH = 3.5
+    TICK_PAD = 3.5
+    LABEL_PAD = 4
+
+    def __init__(self, fig : SVGFigure, x, y, width, height, xlim, ylim):
+        self.fig = fig
+        self.x, self.y, self.width, self.height = x, y, width, height
+        self.xlim, self.ylim = xlim, ylim
+        fig.extend(x, y, x + width, y + height)
+        self.xtick_bottom = y + height # lowest point of the x ticks and labels
+        self.ytick_left = x
+
+    def px(self, v):
+        "Map data x coordinate(s) v to points"
+        x0, x1 = self.xlim
+        return self.x + (np.asarray(v, dtype=float) - x0) / ((x1 - x0) or 1) * self.width
+
+    def py(self, v):
+        "Map data y coordinate(s) v to points"
+        y0, y1 = self.ylim
+        return self.y + self.height - (np.asarray(v, dtype=float) - y0) / ((y1 - y0) or 1) * self.height
+
+    def spines(self, left=True, bottom=True, color='black', width=.3):
+        if left:
+            self.fig.line(self.x, self.y, self.x, self.y + self.height, color, width)
+        if bottom:
+            self.fig.line(self.x, self.y + self.height, self.x + self.width, self.y + self.height, color, width)
+
+    def xticks(self, ticks, size, color, labelcolor, width=.3):
+        bottom = self.y + self.height
+        for v, label in zip(ticks, format_ticks(ticks)):
+            x = float(self.px(v))
+            self.fig.line(x, bottom, x, bottom + self.TICK_LENGTH, color, width)
+            self.fig.text(x, bottom + self.TICK_LENGTH + self.TICK_PAD, label, size, labelcolor)
+        if len(ticks):
+            self.xtick_bottom = bottom + self.TICK_LENGTH + self.TICK_PAD + (_ASCENT + _DESCENT) * size
+
+    def yticks(self, ticks, size, color, labelcolor, width=.3):
+        widest = 0
+        for v, label in zip(ticks, format_ticks(ticks)):
+            y = float(self.py(v))
+            self.fig.line(self.x - self.TICK_LENGTH, y, self.x, y, color, width)
+            self.fig.text(self.x - self.TICK_LENGTH - self.TICK_PAD, y, label, size, labelcolor,
+                          anchor='end', valign='center')
+            widest = max(widest, text_width(label, size))
+        self.ytick_left = self.x - self.TICK_LENGTH - self.TICK_PAD - widest
+
+    def xlabel(self, s, size, color):
+        self.fig.text(self.x + self.width / 2, self.xtick_bottom + self.LABEL_PAD, s, size, color)
+
+    def ylabel(self, s, size, color):
+        self.fig.text(self.ytick_left - self.LABEL_PAD - _DESCENT * size, self.y + self.height / 2,
+                      s, size, color, valign='baseline', rotate=True)
+
+
+def auto_ticks(vmin, vmax, nbins, steps=(1, 2, 2.5, 5, 10), min_n_ticks=2) -> np.ndarray:
+    """
+    Return nice tick locations within [vmin, vmax] for about nbins
+    intervals, as matplotlib's MaxNLocator picks them: the largest step from
+    steps (scaled by a power of ten) no bigger than needed that still puts
+    at least min_n_ticks ticks in the range.
+    """
+    if vmax < vmin:
+        vmin, vmax = vmax, vmin
+    raw_step = (vmax - vmin) / nbins
+    if raw_step <= 0:
+        return np.array([vmin])
+    scale = 10 ** math.floor(math.log10(raw_step))
+    scaled = np.array(steps) * scale
+    istep = np.nonzero(scaled >= raw_step - 1e-12 * scale)[0][0]
+    for step in scaled[:istep+1][::-1]:
+        start = math.floor(vmin / step) * step
+        ticks = start + np.arange(math.floor((vmax - start) / step + 1e-9) + 2) * step
+        ticks = ticks[(ticks >= vmin - 1e-9 * step) & (ticks <= vmax + 1e-9 * step)]
+        if len(ticks) >= min_n_ticks:
+            break
+    return ticks
+
+
+def format_ticks(ticks) -> list:
+    """
+    Return labels for tick values as matplotlib's ScalarFormatter writes
+    them: all with the fewest decimals that tell the ticks apart, and a
+    proper minus sign.
+    """
+    locs = np.asarray(ticks, dtype=float)
+    if len(locs) == 0:
+        return []
+    loc_range = np.ptp(locs) or np.max(np.abs(locs)) or 1
+    loc_range_oom = math.floor(math.log10(loc_range))
+    decimals = max(0, 3 - loc_range_oom)
+    thresh = 1e-3 * 10 ** loc_range_oom
+    while decimals >= 0 and np.abs(locs - np.round(locs, decimals=decimals)).max() < thresh:
+        decimals -= 1
+    decimals += 1
+    return [f"{v:.{decimals}f}".replace('-', '−') for v in locs]
+
+
+def interpolate_colors(start, end, t) -> list:
+    "Return hex colors a fraction t (array of values in [0,1]) of the way from color start to end"
+    a = np.array([int(start[i:i+2], 16) for i in (1, 3, 5)])
+    b = np.array([int(end[i:i+2], 16) for i in (1, 3, 5)])
+    rgb = np.rint(a + np.outer(t, b - a)).astype(int)
+    return [f"#{r:02x}{g:02x}{b:02x}" for r, g, b in rgb]
+
+
+def _attrs(**attrs) -> str:
+    return ''.join(f' {k.replace("_", "-")}="{fmt(v) if isinstance(v, float) else v}"'
+                   for k, v in attrs.items() if v is not None)
@@ -1,16 +1,29 @@
+# Annotations name sklearn and pandas types without importing those packages
+from __future__ import annotations
 import numpy as np
-import pandas as pd
-import graphviz
+import math
+import re
+import string
 from pathlib import Path
-from sklearn import tree
-from graphviz.backend import run
-import matplotlib.pyplot as plt
+import matplotlib
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from animl.trees import *
+from animl.trees import _values
+from animl.parallel import pool_imap, n_processes
 from numbers import Number
+from typing import Mapping, List
 import matplotlib.patches as patches
 import tempfile
-from os import getpid, makedirs, remove
-from IPython.core.display import SVG, display
+import threading
+import time
+import zipfile
+from os import makedirs
+from io import StringIO
+from animl.viz.utils import inline_svg_images, splice_svg_images, optimize_svg, svg_size
+from animl.viz.cache import FigureCache
+from animl.viz.report import RenderReport
+from animl.viz.svg import SVGFigure, Axes, auto_ticks, format_ticks, text_width, interpolate_colors, fmt
 
 
 YELLOW = "#fefecd" # "#fbfbd0" # "#FBFEB0"
@@ -25,6 +38,12 @@ WEDGE_COLOR = GREY #'orange'
 
 HIGHLIGHT_COLOR = '#D67C03'
 
+# Grid (x cells, y cells) and colors for density plots of big regression nodes
+DENSITY_BINS = (50, 25)
+# Whiskers, box and median of box plots of big regression leaves
+BOX_QUANTILES = (.05, .25, .5, .75, .95)
+DENSITY_CMAP = matplotlib.colors.LinearSegmentedColormap.from_list('density', ['#d9e6f5', '#225ea8'])
+
 # How many bins should we have based upon number of classes
 NUM_BINS = [0, 0, 10, 9, 8, 6, 6, 6, 5, 5, 5]
           # 0, 1, 2,  3, 4, 5, 6, 7, 8, 9, 10
@@ -44,41 +63,96 @@ color_blind_friendly_colors = [
 ]
 
 class DTreeViz:
-    def __init__(self,dot):
+    """
+    A graphviz DOT description of a tree visualization. If images is not
+    None, the node figures were rendered in memory: images maps the unique
+    background color of each placeholder cell in the DOT to the SVG text of
+    the figure that belongs there.
+    """
+    def __init__(self, dot, images=None, workspaces=(),
+                 shadow_tree=None, options=None, figures=None, report=None):
         self.dot = dot
+        self.images = images
+        # Private scratch dirs (TemporaryDirectory) holding the node figure
+        # files the DOT refers to; kept here so they live as long as we do.
+        self.workspaces = list(workspaces)
+        # What viz_shadow_tree() needs to derive a visualization for another
+        # instance: the tree, its arguments, and for each figure key the
+        # figure's highlight state and file name or svg text.
+        self.shadow_tree = shadow_tree
+        self.options = options
+        self.figures = figures
+        # Timings of the stages of making this and of svg() and save()
+        self.report = report if report is not None else RenderReport()
+
+    def with_instance(self, X: np.ndarray = None, highlight_path: List[int] = [],
+                      report: RenderReport = None) -> 'DTreeViz':
+        """
+        Return a new visualization of the same tree with the same settings but
+        highlighting instance X (or the nodes in highlight_path) instead. Only
+        the split node figures whose highlighting changes are redrawn; the rest,
+        and the shadow tree, are reused from this one. The new visualization
+        gets its own report, a fresh one unless report is given.
+        """
+        return viz_shadow_tree(self.shadow_tree, X=X, highlight_path=highlight_path,
+                               previous=self, report=report, **self.options)
 
     def _repr_svg_(self):
         return self.svg()
 
-    # def _ipython_display_(self):
-    #     tmp = tempfile.gettempdir()
-    #     svgfilename = f"{tmp}/DTreeViz_{getpid()}.svg"
-    #     self.save(svgfilename)
-    #     # display(SVG(filename="/tmp/t.svg"))
-    #     # print(svgfilename)
-    #     display(SVG(filename=svgfilename))
-
     def topng(self):
         "Return tree image as png binary data"
-        tmp = tempfile.gettempdir()
-        pngfilename = f"{tmp}/DTreeViz_{getpid()}.png"
-        self.save(pngfilename)
-        with open(pngfilename, "rb") as f:
-            png = f.read()
+        with tempfile.TemporaryDirectory() as tmp:
+            pngfilename = f"{tmp}/DTreeViz.png"
+            self.save(pngfilename)
+            with open(pngfilename, "rb") as f:
+                png = f.read()
         return png
 
     def svg(self):
-        tmp = tempfile.gettempdir()
-        svgfilename = f"{tmp}/DTreeViz_{getpid()}.svg"
-        self.save(svgfilename)
-        with open(svgfilename) as f:
-            svg = f.read()
+        """
+        Return the tree as an SVG string with the node figures inlined. DOT
+        goes to graphviz on stdin and SVG comes back on stdout, no PDF or
+        pdf2svg round trip. The figures' shared glyph and marker definitions
+        are merged, see optimize_svg().
+        """
+        import graphviz # only needed once we lay out
+        with self.report.stage('layout', command="dot -Tsvg"):
+            svg = graphviz.Source(self.dot).pipe(format='svg').decode('utf-8')
+        with self.report.stage('inline'):
+            if self.images is not None:
+                svg = splice_svg_images(svg, self.images)
+            else:
+                svg = inline_svg_images(svg)
+        with self.report.stage('optimize'):
+            svg = optimize_svg(svg)
+        self.report.sizes['svg'] = len(svg.encode('utf-8'))
         return svg
 
     def view(self):
-        g = graphviz.Source(self.dot)
+        dot = self.dot
+        if self.images is not None:
+            # the viewer runs after we return so the images must stay on disk
+            dot = self.dot_with_image_files(tempfile.mkdtemp())
+        import graphviz
+        g = graphviz.Source(dot)
         g.view()
 
+    def dot_with_image_files(self, directory) -> str:
+        """
+        For in-memory images, write each figure to an SVG file in directory and
+        return the DOT with the placeholder cells replaced by IMG tags
+        referencing those files, for output formats graphviz must draw itself.
+        """
+        def img(m):
+            attrs, color = m.group(1), m.group(2)
+            filename = f"{directory}/image{color[1:]}.svg"
+            with open(filename, "w") as f:
+                f.write(self.images[color])
+            return f'<td{attrs}><img src="{filename}"/></td>'
+        return re.sub(r'<td([^>]*?) fixedsize="true" width="\d+" height="\d+" bgcolor="(#[0-9a-f]{6})"></td>',
+                      img, self.dot)
+
     def save(self, filename):
         path = Path(filename)
         if not path.parent.exists:
@@ -86,22 +160,25 @@ class DTreeViz:
 
         format = path.suffix[1:] # ".svg" -> "svg" etc...
         if format=='svg':
-            pdffilename = f"{path.parent}/{path.stem}.pdf"
-            g = graphviz.Source(self.dot, format='pdf')
-            g.render(directory=path.parent, filename=path.stem, view=False, cleanup=True)
-            # cmd = ["pdftocairo", "-svg", pdffilename, filename]
-            cmd = ["pdf2svg", pdffilename, filename]
-            # print(' '.join(cmd))
-            # print(f"pdftocairo -svg {pdffilename} {filename}")
-            stdout, stderr = run(cmd, capture_output=True, check=True, quiet=False)
-            remove(pdffilename)
+            with open(filename, "w") as f:
+                f.write(self.svg())
+        elif self.images is not None:
+            with tempfile.TemporaryDirectory() as tmp:
+                with self.report.stage('images'):
+                    dot = self.dot_with_image_files(tmp)
+                DTreeViz(dot, report=self.report).save(filename)
         else:
-            g = graphviz.Source(self.dot, format=format)
-            fname = g.save(directory=path.parent, filename=path.stem)
-            cmd = ["dot", "-Tpng", "-o", filename, fname]
-            # print(' '.join(cmd))
-            stdout, stderr = run(cmd, capture_output=True, check=True, quiet=False)
-            # g.render(directory=path.parent, filename=path.stem, view=False, cleanup=True)
+            import graphviz
+            from graphviz.backend import run
+            with tempfile.TemporaryDirectory() as tmp:
+                g = graphviz.Source(self.dot, format=format)
+                fname = g.save(directory=tmp, filename=path.stem)
+                cmd = ["dot", "-Tpng", "-o", filename, fname]
+                # print(' '.join(cmd))
+                with self.report.stage('convert', command=' '.join(cmd)):
+                    stdout, stderr = run(cmd, capture_output=True, check=True, quiet=False)
+                # g.render(directory=path.parent, filename=path.stem, view=False, cleanup=True)
+        self.report.sizes[str(filename)] = path.stat().st_size
 
 
 def dtreeviz(tree_model: (tree.DecisionTreeRegressor, tree.DecisionTreeClassifier),
@@ -119,7 +196,16 @@ def dtreeviz(tree_model: (tree.DecisionTreeRegressor, tree.DecisionTreeClassifie
              highlight_path: List[int] = [],
              X: np.ndarray = None,
              max_X_features_LR: int = 10,
-             max_X_features_TD: int = 20) \
+             max_X_features_TD: int = 20,
+             n_jobs: int = 1,
+             in_memory: bool = False,
+             cache: FigureCache = None,
+             max_scatter_samples: int = 5000,
+             summarize: bool = False,
+             root_id: int = 0,
+             depth: int = None,
+             report: RenderReport = None,
+             backend: ('matplotlib', 'svg') = 'matplotlib') \
     -> DTreeViz:
     """
     Given a decision tree regressor or classifier, create and return a tree visualization
@@ -158,9 +244,108 @@ def dtreeviz(tree_model: (tree.DecisionTreeRegressor, tree.DecisionTreeClassifie
                             display only those features
                            used to guide X vector down tree. Helps when len(X) is large.
                            Default is 25.
+    :param n_jobs: How many processes to use when running big training sets down the
+                   tree and when rendering the node, leaf and legend figures. Default
+                   is 1, work serially in this process; -1 means use all cores, -2
+                   all but one and so on.
+                   Output is the same either way.
+    :param in_memory: Render node figures to in-memory buffers rather than files in the
+                      temp directory; DTreeViz.svg() then splices them straight into
+                      graphviz's SVG output without touching the filesystem.
+    :param cache: A FigureCache to look up split and leaf figures in before drawing them
+                  and to save newly drawn ones to. Re-rendering the same model then
+                  mostly costs graph layout. Default is None, no caching.
+    :param max_scatter_samples: Regression nodes with more samples than this are drawn
+                                as a 2-D density (split nodes) or box and whisker
+                                summary (leaves) rather than scattering every sample,
+                                which keeps drawing time and SVG size bounded for large
+                                training sets. Default is 5000.
+    :param summarize: Keep only the per-node statistics the figures need rather than
+                      the lists of samples in each node, which take memory proportional
+                      to the number of samples times the tree depth; see
+                      ShadowDecTree.summarize(). All regression nodes are then drawn as
+                      densities or box plots. Default is False.
+    :param root_id: Show only the subtree under the node with this id. Default is 0,
+                    the root of the tree.
+    :param depth: Show only the nodes at most this many levels below root_id. Decision
+                  nodes on the last level are drawn as plain boxes summarizing the
+                  subtree cut off there (node count, number of samples and majority
+                  class or mean) rather than with figures, so big trees can be looked
+                  at a window at a time. Default is None, the whole subtree.
+    :param report: A RenderReport to record the time each stage of the rendering takes
+                   in, per-figure times and output sizes, possibly with a callback or
+                   profiling; it becomes the report field of the result, which is
+                   given a fresh one by default.
+    :param backend: How to draw the node, leaf and legend figures: 'matplotlib', or
+                    'svg' to build them directly as SVG from the node statistics, which
+                    is one to two orders of magnitude faster per figure and makes files
+                    a fraction of the size. The svg figures look much the same but their
+                    text is set in the viewer's font. They aren't cached since drawing
+                    them costs about what a cache lookup does. Default is 'matplotlib'.
 
     :return: A string in graphviz DOT language that describes the decision tree.
     """
+    if report is None:
+        report = RenderReport()
+    with report.stage('shadow_tree'):
+        shadow_tree = ShadowDecTree(tree_model, X_train, y_train,
+                                    feature_names=feature_names, class_names=class_names,
+                                    n_jobs=n_jobs)
+    return viz_shadow_tree(shadow_tree, target_name,
+                           precision=precision,
+                           orientation=orientation,
+                           show_root_edge_labels=show_root_edge_labels,
+                           show_node_labels=show_node_labels,
+                           fancy=fancy,
+                           histtype=histtype,
+                           highlight_path=highlight_path,
+                           X=X,
+                           max_X_features_LR=max_X_features_LR,
+                           max_X_features_TD=max_X_features_TD,
+                           n_jobs=n_jobs,
+                           in_memory=in_memory,
+                           cache=cache,
+                           max_scatter_samples=max_scatter_samples,
+                           summarize=summarize,
+                           root_id=root_id,
+                           depth=depth,
+                           report=report,
+                           backend=backend)
+
+
+def viz_shadow_tree(shadow_tree : ShadowDecTree,
+                    target_name: str,
+                    precision: int = 2,
+                    orientation: ('TD', 'LR') = "TD",
+                    show_root_edge_labels: bool = True,
+                    show_node_labels: bool = False,
+                    fancy: bool = True,
+                    histtype: ('bar', 'barstacked') = 'barstacked',
+                    highlight_path: List[int] = [],
+                    X: np.ndarray = None,
+                    max_X_features_LR: int = 10,
+                    max_X_features_TD: int = 20,
+                    n_jobs: int = 1,
+                    in_memory: bool = False,
+                    cache: FigureCache = None,
+                    max_scatter_samples: int = 5000,
+                    summarize: bool = False,
+                    root_id: int = 0,
+                    depth: int = None,
+                    report: RenderReport = None,
+                    backend: ('matplotlib', 'svg') = 'matplotlib',
+                    previous: DTreeViz = None) \
+    -> DTreeViz:
+    """
+    Same as dtreeviz() but visualize an already built shadow tree; see dtreeviz()
+    for the arguments.
+
+    :param previous: A DTreeViz made by this function from the same shadow tree
+                     and arguments, but perhaps a different X or highlight_path.
+                     Its node figures are reused where they would come out the
+                     same, so only split nodes whose highlighting changed are
+                     redrawn.
+    """
     def round(v,ndigits=precision):
         return format(v, '.' + str(ndigits) + 'f')
 
@@ -177,7 +362,7 @@ def dtreeviz(tree_model: (tree.DecisionTreeRegressor, tree.DecisionTreeClassifie
             html = f"""<table border="0">
             {labelgraph}
             <tr>
-                    <td port="img"><img src="{tmp}/node{node.id}_{getpid()}.svg"/></td>
+                    {img_cell(f"node{node.id}", ' port="img"')}
             </tr>
             </table>"""
         else:
@@ -195,7 +380,7 @@ def dtreeviz(tree_model: (tree.DecisionTreeRegressor, tree.DecisionTreeClassifie
         html = f"""<table border="0">
         {labelgraph}
         <tr>
-                <td port="img"><img src="{tmp}/leaf{node.id}_{getpid()}.svg"/></td>
+                {img_cell(f"leaf{node.id}", ' port="img"')}
         </tr>
         </table>"""
         if node.id in highlight_path:
@@ -209,7 +394,7 @@ def dtreeviz(tree_model: (tree.DecisionTreeRegressor, tree.DecisionTreeClassifie
         html = f"""<table border="0" CELLBORDER="0">
         {labelgraph}
         <tr>
-                <td port="img"><img src="{tmp}/leaf{node.id}_{getpid()}.svg"/></td>
+                {img_cell(f"leaf{node.id}", ' port="img"')}
         </tr>
         </table>"""
         if node.id in highlight_path:
@@ -217,6 +402,40 @@ def dtreeviz(tree_model: (tree.DecisionTreeRegressor, tree.DecisionTreeClassifie
         else:
             return f'leaf{node.id} [margin="0" shape=plain label=<{html}>]'
 
+    def subtree_node(node, label_fontsize: int = 11):
+        labelgraph = node_label(node) if show_node_labels else ''
+        if shadow_tree.isclassifier():
+            pred = shadow_tree.class_names[shadow_tree.node_predictions([node.id])[0]]
+        else:
+            pred = round(shadow_tree.node_predictions([node.id])[0])
+        lines = [f"{subtree_sizes[node.id]} nodes", f"n={node.nsamples()}", f"{target_name}={pred}"]
+        rows = ''.join(f'<tr><td><font face="Helvetica" color="{GREY}" point-size="{label_fontsize}">{line}</font></td></tr>'
+                       for line in lines)
+        html = f"""<table border="0" cellspacing="0" cellpadding="1">
+        {labelgraph}
+        {rows}
+        </table>"""
+        color = HIGHLIGHT_COLOR if node.id in highlight_path else GREY
+        return f'subtree{node.id} [margin="0.05" shape=box penwidth=".5" color="{color}" style="dashed" label=<{html}>]'
+
+    def gr_name(node):
+        if node.isleaf():
+            return f"leaf{node.id}"
+        if node.id in truncated_ids:
+            return f"subtree{node.id}"
+        return node_name(node)
+
+    def img_cell(key, attrs=''):
+        if not in_memory:
+            return f'<td{attrs}><img src="{figure_refs[key][1]}"/></td>'
+        # Reserve an empty cell the size of the image, tagged with a unique
+        # background color so DTreeViz can find it and splice the image in
+        # after graphviz does the layout.
+        w, h = svg_size(figure_refs[key][1])
+        if 'cellpadding' not in attrs:
+            attrs += ' cellpadding="0"'
+        return f'<td{attrs} fixedsize="true" width="{math.ceil(w)}" height="{math.ceil(h)}" bgcolor="{image_colors[key]}"></td>'
+
     def node_label(node):
         return f'<tr><td CELLPADDING="0" CELLSPACING="0"><font face="Helvetica" color="{GREY}" point-size="14"><i>Node {node.id}</i></font></td></tr>'
 
@@ -225,8 +444,8 @@ def dtreeviz(tree_model: (tree.DecisionTreeRegressor, tree.DecisionTreeClassifie
         for i,cl in enumerate(class_values):
             html = f"""
             <tr>
-                <td border="0" cellspacing="0" cellpadding="0"><img src="{tmp}/legend{i}_{getpid()}.svg"/></td>
-                <td align="left"><font face="Helvetica" color="{GREY}" point-size="{label_fontsize}">{class_names[cl]}</font></td>
+                {img_cell(f"legend{i}", ' border="0" cellspacing="0" cellpadding="0"')}
+                <td align="left"><font face="Helvetica" color="{GREY}" point-size="{label_fontsize}">{shadow_tree.class_names[cl]}</font></td>
             </tr>
             """
             elements.append(html)
@@ -255,7 +474,7 @@ def dtreeviz(tree_model: (tree.DecisionTreeRegressor, tree.DecisionTreeClassifie
         headers = []
         features_used = [node.feature() for node in path[:-1]] # don't include leaf
         display_X = X
-        display_feature_names = feature_names
+        display_feature_names = shadow_tree.feature_names
         highlight_feature_indexes = features_used
         if (orientation=='TD' and len(X)>max_X_features_TD) or\
            (orientation == 'LR' and len(X) > max_X_features_LR):
@@ -296,11 +515,15 @@ def dtreeviz(tree_model: (tree.DecisionTreeRegressor, tree.DecisionTreeClassifie
         if X is None:
             return ""
         pred, path = shadow_tree.predict(X)
-        leaf = f"leaf{path[-1].id}"
         if shadow_tree.isclassifier():
             edge_label = f" Prediction<br/> {path[-1].prediction_name()}"
         else:
             edge_label = f" Prediction<br/> {round(path[-1].prediction(), precision)}"
+        # from the last node of X's path that is shown, if it reaches the window
+        shown = [node for node in path if node.id in window_ids]
+        edge = ""
+        if shown:
+            edge = f"""{gr_name(shown[-1])} -> X_y [dir=back; penwidth="1.2" color="{HIGHLIGHT_COLOR}" label=<<font face="Helvetica" color="{GREY}" point-size="{11}">{edge_label}</font>>]"""
         return f"""
             subgraph cluster_instance {{
                 style=invis;
@@ -308,9 +531,12 @@ def dtreeviz(tree_model: (tree.DecisionTreeRegressor, tree.DecisionTreeClassifie
                 {instance_html(path)}
                 >]
             }}
-            {leaf} -> X_y [dir=back; penwidth="1.2" color="{HIGHLIGHT_COLOR}" label=<<font face="Helvetica" color="{GREY}" point-size="{11}">{edge_label}</font>>]
+            {edge}
             """
 
+    if backend not in ('matplotlib', 'svg'):
+        raise ValueError(f"backend must be 'matplotlib' or 'svg', not {backend!r}")
+
     if orientation=="TD":
         ranksep = ".2"
         nodesep = "0.1"
@@ -322,16 +548,31 @@ def dtreeviz(tree_model: (tree.DecisionTreeRegressor, tree.DecisionTreeClassifie
             ranksep = ".05"
             nodesep = "0.09"
 
-    tmp = tempfile.gettempdir()
-    # tmp = "/tmp"
-
-    shadow_tree = ShadowDecTree(tree_model, X_train, y_train,
-                                feature_names=feature_names, class_names=class_names)
+    # Each call gets its own scratch dir for node figures so concurrent calls,
+    # in threads or processes, can't overwrite each other's images.
+    workspaces = []
+    if not in_memory:
+        workspace = tempfile.TemporaryDirectory(prefix="dtreeviz_")
+        tmp = workspace.name
+        workspaces.append(workspace)
+    if previous is not None: # we may refer to its figures
+        workspaces += previous.workspaces
 
     if X is not None:
         pred, path  = shadow_tree.predict(X)
         highlight_path = [n.id for n in path]
 
+    # Only nodes in the window get figures and go to graphviz; decision nodes
+    # it cuts off become summary boxes.
+    internal_ids, leaf_ids, truncated_ids = shadow_tree.window(root_id, depth)
+    window_internal = [ShadowDecTreeNode(shadow_tree, i) for i in internal_ids.tolist()]
+    window_leaves = [ShadowDecTreeNode(shadow_tree, i) for i in leaf_ids.tolist()]
+    window_truncated = [ShadowDecTreeNode(shadow_tree, i) for i in truncated_ids.tolist()]
+    truncated_ids = set(truncated_ids.tolist())
+    window_ids = set(internal_ids.tolist()) | set(leaf_ids.tolist()) | truncated_ids
+    if truncated_ids:
+        subtree_sizes = shadow_tree.subtree_sizes()
+
     n_classes = shadow_tree.nclasses()
     color_values = color_blind_friendly_colors[n_classes]
 
@@ -341,115 +582,163 @@ def dtreeviz(tree_model: (tree.DecisionTreeRegressor, tree.DecisionTreeClassifie
         class_values = shadow_tree.unique_target_values
         colors = {v:color_values[i] for i,v in enumerate(class_values)}
 
-    y_range = (min(y_train)*1.03, max(y_train)*1.03) # same y axis for all
+    y_train = shadow_tree.y_train
+    y_range = (np.min(y_train)*1.03, np.max(y_train)*1.03) # same y axis for all
 
     if shadow_tree.isclassifier():
-        draw_legend_boxes(shadow_tree, f"{tmp}/legend")
+        nbins = get_num_bins(histtype, n_classes)
 
-    if isinstance(X_train,pd.DataFrame):
-        X_train = X_train.values
-    if isinstance(y_train,pd.Series):
-        y_train = y_train.values
+    if report is None:
+        report = RenderReport()
+    with report.stage('statistics'):
+        if summarize and shadow_tree.has_samples():
+            shadow_tree.summarize(histogram_bins=[nbins] if shadow_tree.isclassifier() else [],
+                                  density_bins=DENSITY_BINS, y_range=y_range,
+                                  quantiles=BOX_QUANTILES)
 
-    # Find max height (count) for any bar in any node
-    if shadow_tree.isclassifier():
-        nbins = get_num_bins(histtype, n_classes)
-        node_heights = shadow_tree.get_split_node_heights(X_train, y_train, nbins=nbins)
+        # Find max height (count) for any bar in any node
+        if shadow_tree.isclassifier():
+            node_heights = shadow_tree.get_split_node_heights(nbins=nbins)
+
+    # NODE_FIGURES kinds for the backend; svg figures aren't worth caching
+    suffix = '_svg' if backend == 'svg' else ''
+    cached = dict(cache=cache) if backend == 'matplotlib' else {}
+
+    # Collect every figure to draw then render them all, possibly in parallel.
+    # Figures from a previous rendering that would come out the same are reused.
+    figure_refs = {} # key -> (state, file name or svg text)
+    figure_keys = [] # figures to draw
+    figures = []
+    def figure(key, kind, node_id, highlight=None, **kwargs):
+        state = (kind, highlight)
+        if previous is not None and key in previous.figures and previous.figures[key][0]==state:
+            figure_refs[key] = previous.figures[key]
+            return
+        if not in_memory: # else no filename; rendering returns the svg text
+            kwargs['filename'] = f"{tmp}/{key}.svg"
+        figure_refs[key] = (state, kwargs.get('filename'))
+        figure_keys.append(key)
+        figures.append((kind, node_id, kwargs))
 
-    internal = []
-    for node in shadow_tree.internal:
-        if fancy:
+    if shadow_tree.isclassifier():
+        for i, cl in enumerate(class_values):
+            figure(f"legend{i}", 'legend' + suffix, None, color=colors[cl])
+
+    if fancy:
+        for node in window_internal:
+            # X's value is drawn as a 2nd wedge on split nodes along its path
+            highlight = None
+            if X is not None and node.id in highlight_path:
+                highlight = X[node.feature()]
             if shadow_tree.isclassifier():
-                class_split_viz(node, X_train, y_train,
-                                filename=f"{tmp}/node{node.id}_{getpid()}.svg",
-                                precision=precision,
-                                colors=colors,
-                                histtype=histtype,
-                                node_heights=node_heights,
-                                X = X,
-                                highlight_node=node.id in highlight_path)
+                figure(f"node{node.id}", 'class_split' + suffix, node.id, highlight,
+                       precision=precision,
+                       colors=colors,
+                       histtype=histtype,
+                       node_heights=node_heights,
+                       X = X,
+                       highlight_node=highlight is not None,
+                       **cached)
             else:
-                regr_split_viz(node, X_train, y_train,
-                               filename=f"{tmp}/node{node.id}_{getpid()}.svg",
-                               target_name=target_name,
-                               y_range=y_range,
-                               precision=precision,
-                               X=X,
-                               highlight_node=node.id in highlight_path)
-
-        nname = node_name(node)
-        gr_node = split_node(node.feature_name(), nname, split=round(node.split()))
-        internal.append(gr_node)
-
-    leaves = []
-    for node in shadow_tree.leaves:
+                figure(f"node{node.id}", 'regr_split' + suffix, node.id, highlight,
+                       target_name=target_name,
+                       y_range=y_range,
+                       precision=precision,
+                       X=X,
+                       highlight_node=highlight is not None,
+                       max_scatter_samples=max_scatter_samples,
+                       **cached)
+
+    for node in window_leaves:
         if shadow_tree.isclassifier():
-            class_leaf_viz(node, colors=color_values,
-                           filename=f"{tmp}/leaf{node.id}_{getpid()}.svg")
-            leaves.append( class_leaf_node(node) )
+            figure(f"leaf{node.id}", 'class_leaf' + suffix, node.id, colors=color_values, **cached)
         else:
             # for now, always gen leaf
-            regr_leaf_viz(node, y_train, target_name=target_name,
-                          filename=f"{tmp}/leaf{node.id}_{getpid()}.svg",
-                          y_range=y_range, precision=precision)
-            leaves.append( regr_leaf_node(node) )
-
-    fromport = ""
-    toport = ""
-    if fancy and orientation=="TD":
-        fromport = ":img:s"
-        toport = ":img:n"
-    elif fancy:
-        fromport = ":img:e"
-        toport = ":img:w"
+            figure(f"leaf{node.id}", 'regr_leaf' + suffix, node.id,
+                   target_name=target_name,
+                   y_range=y_range, precision=precision,
+                   max_scatter_samples=max_scatter_samples,
+                   **cached)
+
+    with report.stage('figures', drawn=len(figures), reused=len(figure_refs) - len(figures)):
+        seconds = []
+        rendered = render_node_figures(shadow_tree, figures, n_jobs=n_jobs, seconds=seconds)
+    report.nodes.update(zip(figure_keys, seconds))
+    image_colors = None
+    if in_memory:
+        for key, svg in zip(figure_keys, rendered):
+            figure_refs[key] = (figure_refs[key][0], svg)
+        image_colors = {key: f"#fe{i:04x}" for i, key in enumerate(figure_refs)}
+        report.sizes['figures'] = sum(len(svg.encode('utf-8')) for svg in rendered)
+    else:
+        report.sizes['figures'] = sum(Path(kwargs['filename']).stat().st_size for _, _, kwargs in figures)
 
-    if shadow_tree.isclassifier():
+    with report.stage('dot'):
+        internal = []
+        for node in window_internal:
+            nname = node_name(node)
+            gr_node = split_node(node.feature_name(), nname, split=round(node.split()))
+            internal.append(gr_node)
+
+        leaves = []
+        for node in window_leaves:
+            if shadow_tree.isclassifier():
+                leaves.append( class_leaf_node(node) )
+            else:
+                leaves.append( regr_leaf_node(node) )
+        for node in window_truncated:
+            leaves.append( subtree_node(node) )
+
+        fromport = ""
+        toport = ""
+        if fancy and orientation=="TD":
+            fromport = ":img:s"
+            toport = ":img:n"
+        elif fancy:
+            fromport = ":img:e"
+            toport = ":img:w"
+
+        if shadow_tree.isclassifier():
+            fromport = toport = ""
+        # in the end, it looks better without the downward edges emanating from same point
         fromport = toport = ""
-    # in the end, it looks better without the downward edges emanating from same point
-    fromport = toport = ""
-
-    show_edge_labels = False
-    all_llabel = '&lt;' if show_edge_labels else ''
-    all_rlabel = '&ge;' if show_edge_labels else ''
-    root_llabel = '&lt;' if show_root_edge_labels else ''
-    root_rlabel = '&ge;' if show_root_edge_labels else ''
-
-    edges = []
-    # non leaf edges with > and <=
-    for node in shadow_tree.internal:
-        nname = node_name(node)
-        if node.left.isleaf():
-            left_node_name ='leaf%d' % node.left.id
-        else:
-            left_node_name = node_name(node.left)
-        if node.right.isleaf():
-            right_node_name ='leaf%d' % node.right.id
-        else:
-            right_node_name = node_name(node.right)
-        llabel = all_llabel
-        rlabel = all_rlabel
-        if node==shadow_tree.root:
-            llabel = root_llabel
-            rlabel = root_rlabel
-        lcolor = rcolor = GREY
-        lpw = rpw = "0.3"
-        if node.left.id in highlight_path:
-            lcolor = HIGHLIGHT_COLOR
-            lpw = "1.2"
-        if node.right.id in highlight_path:
-            rcolor = HIGHLIGHT_COLOR
-            rpw = "1.2"
-        edges.append( f'{nname}{fromport} -> {left_node_name}{toport} [penwidth={lpw} color="{lcolor}" label=<{llabel}>]' )
-        edges.append( f'{nname}{fromport} -> {right_node_name}{toport} [penwidth={rpw} color="{rcolor}" label=<{rlabel}>]' )
-        edges.append(f"""
+
+        show_edge_labels = False
+        all_llabel = '&lt;' if show_edge_labels else ''
+        all_rlabel = '&ge;' if show_edge_labels else ''
+        root_llabel = '&lt;' if show_root_edge_labels else ''
+        root_rlabel = '&ge;' if show_root_edge_labels else ''
+
+        edges = []
+        # non leaf edges with > and <=
+        for node in window_internal:
+            nname = node_name(node)
+            left_node_name = gr_name(node.left)
+            right_node_name = gr_name(node.right)
+            llabel = all_llabel
+            rlabel = all_rlabel
+            if node.id==root_id:
+                llabel = root_llabel
+                rlabel = root_rlabel
+            lcolor = rcolor = GREY
+            lpw = rpw = "0.3"
+            if node.left.id in highlight_path:
+                lcolor = HIGHLIGHT_COLOR
+                lpw = "1.2"
+            if node.right.id in highlight_path:
+                rcolor = HIGHLIGHT_COLOR
+                rpw = "1.2"
+            edges.append( f'{nname}{fromport} -> {left_node_name}{toport} [penwidth={lpw} color="{lcolor}" label=<{llabel}>]' )
+            edges.append( f'{nname}{fromport} -> {right_node_name}{toport} [penwidth={rpw} color="{rcolor}" label=<{rlabel}>]' )
+            edges.append(f"""
         {{
             rank=same;
             {left_node_name} -> {right_node_name} [style=invis]
         }}
         """)
 
-    newline = "\n\t"
-    dot = f"""
+        newline = "\n\t"
+        dot = f"""
 digraph G {{
     splines=line;
     nodesep={nodesep};
@@ -467,8 +756,170 @@ digraph G {{
     {instance_gr()}
 }}
     """
+    report.sizes['dot'] = len(dot.encode('utf-8'))
+
+    images = None
+    if in_memory:
+        images = {image_colors[key]: svg for key, (_, svg) in figure_refs.items()}
+    options = dict(target_name=target_name,
+                   precision=precision,
+                   orientation=orientation,
+                   show_root_edge_labels=show_root_edge_labels,
+                   show_node_labels=show_node_labels,
+                   fancy=fancy,
+                   histtype=histtype,
+                   max_X_features_LR=max_X_features_LR,
+                   max_X_features_TD=max_X_features_TD,
+                   n_jobs=n_jobs,
+                   in_memory=in_memory,
+                   cache=cache,
+                   max_scatter_samples=max_scatter_samples,
+                   summarize=summarize,
+                   root_id=root_id,
+                   depth=depth,
+                   backend=backend)
+    return DTreeViz(dot, images=images, workspaces=workspaces,
+                    shadow_tree=shadow_tree, options=options, figures=figure_refs,
+                    report=report)
+
+
+def dtreeviz_instances(tree_model: (tree.DecisionTreeRegressor, tree.DecisionTreeClassifier),
+                       X_train: (pd.DataFrame, np.ndarray),
+                       y_train: (pd.Series, np.ndarray),
+                       feature_names: List[str],
+                       target_name: str,
+                       instances: (pd.DataFrame, np.ndarray),
+                       output: str,
+                       class_names: (Mapping[Number, str], List[str]) = None,
+                       format: str = 'svg',
+                       n_jobs: int = 1,
+                       **kwargs) \
+    -> dict:
+    """
+    Render the decision tree once for each row of instances, highlighting that
+    row's path, and write the results to directory output as instance{i}.svg
+    (or whatever format says), or into a zip archive if output ends in ".zip".
+
+    The shadow tree and the figures of nodes off an instance's path are made
+    once and shared; per instance, only the split nodes on its path are redrawn
+    and the graph laid out. With n_jobs other than 1, instances are rendered
+    in a pool of worker processes (see animl.parallel.n_processes()), each
+    of which gets the shared state once. Outputs are written as they are finished, so memory
+    use doesn't grow with the number of instances.
+
+    :param instances: A data frame or 2-D matrix with one instance to explain per row.
+    :param output: The directory or .zip file to write to.
+    :param format: Output format, anything DTreeViz.save() supports. Default is svg.
+    :param kwargs: Other dtreeviz() arguments, such as orientation, fancy or cache.
+    :return: Throughput: a dict with the number of instances, elapsed
+             seconds and instances per second.
+    """
+    start = time.perf_counter()
+    instances = _values(instances)
+
+    shadow_tree = ShadowDecTree(tree_model, X_train, y_train,
+                                feature_names=feature_names, class_names=class_names,
+                                n_jobs=n_jobs)
+    base = viz_shadow_tree(shadow_tree, target_name, in_memory=True, n_jobs=n_jobs, **kwargs)
+    base.options['n_jobs'] = 1 # parallelism is across instances from here on
+
+    archive = None
+    if output.endswith(".zip"):
+        archive = zipfile.ZipFile(output, "w", compression=zipfile.ZIP_DEFLATED)
+    else:
+        makedirs(output, exist_ok=True)
+    directory = None if archive is not None else output
+
+    jobs = [(i, x, format, directory) for i, x in enumerate(instances)]
+    try:
+        _write_instances(pool_imap(render_instance, jobs, base, n_jobs), archive)
+    finally:
+        if archive is not None:
+            archive.close()
 
-    return DTreeViz(dot)
+    seconds = time.perf_counter() - start
+    return {'instances': len(instances),
+            'seconds': seconds,
+            'instances_per_second': len(instances) / seconds}
+
+
+def render_instance(viz : DTreeViz, job):
+    """
+    Render viz highlighting one instance, described by an (index, instance,
+    format, directory) tuple; see dtreeviz_instances(). Write the result to
+    directory and return its file name or, if directory is None, return the
+    file name and the data.
+    """
+    i, x, format, directory = job
+    name = f"instance{i}.{format}"
+    v = viz.with_instance(x)
+    if format == 'svg':
+        data = v.svg().encode('utf-8')
+    else:
+        with tempfile.TemporaryDirectory() as tmp:
+            v.save(f"{tmp}/{name}")
+            with open(f"{tmp}/{name}", "rb") as f:
+                data = f.read()
+    if directory is None:
+        return name, data
+    with open(f"{directory}/{name}", "wb") as f:
+        f.write(data)
+    return name
+
+
+def _write_instances(results, archive):
+    for result in results:
+        if archive is not None:
+            archive.writestr(*result)
+
+
+def render_node_figures(shadow_tree : ShadowDecTree, figures, n_jobs : int = 1,
+                        seconds : list = None) -> list:
+    """
+    Render a list of node figures described as (kind, node id, kwargs) tuples,
+    where kind is one of the keys of NODE_FIGURES, and return the list of
+    results. Figures don't depend on each other so with n_jobs other than 1
+    they are drawn in a pool of worker processes (see
+    animl.parallel.n_processes()). The shadow tree, and the training data it
+    holds, goes to each worker once, not with every figure. If seconds is a
+    list, the time each figure took to draw is appended to it.
+    """
+    if n_processes(n_jobs) > 1 and len(figures) > 1:
+        # Fill node samples and per-feature stats before the workers get their
+        # copy of the tree so that each of them doesn't scan the same data
+        # again; after summarize() the figures draw from statistics instead
+        if shadow_tree.has_samples():
+            shadow_tree.build_samples()
+        for feature in np.unique(shadow_tree.split_features()):
+            shadow_tree.feature_range(feature)
+    timed = list(pool_imap(_render_timed, figures, shadow_tree, n_jobs))
+    if seconds is not None:
+        seconds.extend(t for _, t in timed)
+    return [result for result, _ in timed]
+
+
+def _render_timed(shadow_tree, figure):
+    start = time.perf_counter()
+    result = render_node_figure(shadow_tree, figure)
+    return result, time.perf_counter() - start
+
+
+def render_node_figure(shadow_tree : ShadowDecTree, figure):
+    """
+    Draw one (kind, node id, kwargs) figure; see render_node_figures(). If
+    kwargs has no filename, draw into memory and return the SVG text.
+    """
+    kind, node_id, kwargs = figure
+    buffer = None
+    if 'filename' not in kwargs:
+        buffer = StringIO()
+        kwargs = dict(kwargs, filename=buffer)
+    if node_id is None:
+        NODE_FIGURES[kind](**kwargs)
+    else:
+        NODE_FIGURES[kind](ShadowDecTreeNode(shadow_tree, node_id), **kwargs)
+    if buffer is not None:
+        return buffer.getvalue()
 
 
 def class_split_viz(node: ShadowDecTreeNode,
@@ -482,22 +933,39 @@ def class_split_viz(node: ShadowDecTreeNode,
                     precision=1,
                     histtype: ('bar', 'barstacked') = 'barstacked',
                     X : np.array = None,
-                    highlight_node : bool = False
+                    highlight_node : bool = False,
+                    cache : FigureCache = None
                     ):
     height_range = (.5, 1.5)
     h = prop_size(n=node_heights[node.id], counts=node_heights.values(), output_range=height_range)
     figsize=(3.3, h)
-    fig, ax = plt.subplots(1, 1, figsize=figsize)
 
     feature_name = node.feature_name()
 
-    # Get X, y data for all samples associated with this node.
-    X_feature = X_train[:, node.feature()]
-    X_feature, y_train = X_feature[node.samples()], y_train[node.samples()]
-
     n_classes = node.shadow_tree.nclasses()
     nbins = get_num_bins(histtype, n_classes)
-    overall_feature_range = (np.min(X_train[:, node.feature()]), np.max(X_train[:, node.feature()]))
+    overall_feature_range = node.shadow_tree.feature_range(node.feature())
+
+    class_names = node.shadow_tree.class_names
+
+    class_values = node.shadow_tree.unique_target_values
+    X_colors = [colors[cl] for cl in class_values]
+
+    # Bin counts come precomputed from the shadow tree (the same ones used
+    # for node_heights); hand them to hist() as weights on the bin starts.
+    bins = node.shadow_tree.feature_bins(node.feature(), nbins)
+    counts = node.shadow_tree.get_split_node_histograms(nbins)[node.id]
+
+    if cache is not None and filename is not None:
+        key = FigureCache.key('class_split_viz', h, feature_name, node.split(), overall_feature_range,
+                              bins, counts, X_colors, histtype, ticks_fontsize, label_fontsize, precision,
+                              X[node.feature()] if highlight_node else None)
+        return cache.render(key, filename,
+                            lambda f: class_split_viz(node, X_train, y_train, colors, node_heights, f,
+                                                      ticks_fontsize, label_fontsize, precision, histtype,
+                                                      X, highlight_node))
+
+    fig, ax = template_figure('class_split', figsize, filename)
 
     ax.set_xlabel(f"{feature_name}", fontsize=label_fontsize, fontname="Arial",
                   color=GREY)
@@ -506,20 +974,12 @@ def class_split_viz(node: ShadowDecTreeNode,
     ax.spines['left'].set_linewidth(.3)
     ax.spines['bottom'].set_linewidth(.3)
 
-    class_names = node.shadow_tree.class_names
-
-    r = overall_feature_range[1]-overall_feature_range[0]
-
-    class_values = node.shadow_tree.unique_target_values
-    X_hist = [X_feature[y_train == cl] for cl in class_values]
-    X_colors = [colors[cl] for cl in class_values]
-    binwidth = r / nbins
-
-    hist, bins, barcontainers = ax.hist(X_hist,
+    hist, bins, barcontainers = ax.hist([bins[:-1]] * len(class_values),
+                                        weights=[counts[:, i] for i in range(len(class_values))],
                                         color=X_colors,
                                         align='mid',
                                         histtype=histtype,
-                                        bins=np.arange(overall_feature_range[0],overall_feature_range[1] + binwidth, binwidth),
+                                        bins=bins,
                                         label=class_names)
 
     ax.set_xlim(*overall_feature_range)
@@ -557,19 +1017,24 @@ def class_split_viz(node: ShadowDecTreeNode,
             rect.set_linewidth(.5)
             rect.set_edgecolor(GREY)
 
-    if filename is not None:
-        plt.savefig(filename, bbox_inches='tight', pad_inches=0)
-        plt.close()
+    return save_figure(fig, filename)
 
 
 def class_leaf_viz(node : ShadowDecTreeNode,
                    colors : List[str],
-                   filename: str):
+                   filename: str,
+                   cache : FigureCache = None):
     size = prop_size(node.nsamples(), counts=node.shadow_tree.leaf_sample_counts(),
                      output_range=(1.01, 1.5))
     # we visually need n=1 and n=9 to appear different but diff between 300 and 400 is no big deal
     size = np.sqrt(np.log(size))
-    draw_piechart(node.class_counts(), size=size, colors=colors, filename=filename, label=f"n={node.nsamples()}")
+    counts = node.class_counts()
+    label = f"n={node.nsamples()}"
+    if cache is not None and filename is not None:
+        key = FigureCache.key('class_leaf_viz', counts, size, colors, label)
+        return cache.render(key, filename,
+                            lambda f: draw_piechart(counts, size=size, colors=colors, filename=f, label=label))
+    return draw_piechart(counts, size=size, colors=colors, filename=filename, label=label)
 
 
 def regr_split_viz(node: ShadowDecTreeNode,
@@ -582,13 +1047,40 @@ def regr_split_viz(node: ShadowDecTreeNode,
                    label_fontsize: int = 9,
                    precision=1,
                    X : np.array = None,
-                   highlight_node : bool = False):
+                   highlight_node : bool = False,
+                   cache : FigureCache = None,
+                   max_scatter_samples : int = 5000):
     figsize = (2.5, 1.1)
-    fig, ax = plt.subplots(1, 1, figsize=figsize)
+    shadow_tree = node.shadow_tree
+    # Without samples, only the density and side means are known
+    density = not shadow_tree.has_samples() or node.nsamples() > max_scatter_samples
+    if cache is not None and filename is not None:
+        isroot = node==shadow_tree.root
+        if shadow_tree.has_samples():
+            samples = node.samples()
+            data = (X_train[samples, node.feature()], y_train[samples])
+        else:
+            means = shadow_tree.node_target_means()
+            data = (shadow_tree.get_split_node_densities(DENSITY_BINS, y_range)[node.id],
+                    means[shadow_tree.children_left[node.id]], means[shadow_tree.children_right[node.id]])
+        key = FigureCache.key('regr_split_viz', node.feature_name(), node.split(),
+                              shadow_tree.feature_range(node.feature()),
+                              *data,
+                              target_name if isroot else None, y_range,
+                              ticks_fontsize, label_fontsize, precision,
+                              X[node.feature()] if highlight_node else None,
+                              density)
+        return cache.render(key, filename,
+                            lambda f: regr_split_viz(node, X_train, y_train, target_name, f, y_range,
+                                                     ticks_fontsize, label_fontsize, precision,
+                                                     X, highlight_node,
+                                                     max_scatter_samples=max_scatter_samples))
+
+    fig, ax = template_figure('regr_split', figsize, filename)
     ax.tick_params(colors=GREY)
 
     feature_name = node.feature_name()
-    # ticklabelpad = plt.rcParams['xtick.major.pad']
+    # ticklabelpad = matplotlib.rcParams['xtick.major.pad']
     # ax.annotate(f"{feature_name}",
     #             xy=(.5, 0), xytext=(.5, -3*ticklabelpad), ha='center', va='top',
     #             xycoords='axes fraction', textcoords='offset points',
@@ -606,11 +1098,7 @@ def regr_split_viz(node: ShadowDecTreeNode,
     ax.spines['bottom'].set_linewidth(.3)
     ax.tick_params(axis='both', which='major', width=.3, labelcolor=GREY, labelsize=ticks_fontsize)
 
-    # Get X, y data for all samples associated with this node.
-    X_feature = X_train[:,node.feature()]
-    X_feature, y_train = X_feature[node.samples()], y_train[node.samples()]
-
-    overall_feature_range = (np.min(X_train[:,node.feature()]), np.max(X_train[:,node.feature()]))
+    overall_feature_range = node.shadow_tree.feature_range(node.feature())
     ax.set_xlim(*overall_feature_range)
 
     xmin, xmax = overall_feature_range
@@ -621,14 +1109,28 @@ def regr_split_viz(node: ShadowDecTreeNode,
         xticks += [node.split()]
     ax.set_xticks(xticks)
 
-    ax.scatter(X_feature, y_train, s=5, c='#225ea8', alpha=.4)
-    left, right = node.split_samples()
-    left = y_train[left]
-    right = y_train[right]
+    if density:
+        # Too many points to scatter; shade a grid by how many fall in each cell
+        counts = shadow_tree.get_split_node_densities(DENSITY_BINS, y_range)[node.id]
+        ax.imshow(np.ma.masked_equal(np.log1p(counts), 0),
+                  extent=(*overall_feature_range, *y_range), origin='lower',
+                  aspect='auto', interpolation='nearest', cmap=DENSITY_CMAP)
+    if shadow_tree.has_samples():
+        # Get X, y data for all samples associated with this node.
+        X_feature = X_train[:,node.feature()]
+        X_feature, y_train = X_feature[node.samples()], y_train[node.samples()]
+        if not density:
+            ax.scatter(X_feature, y_train, s=5, c='#225ea8', alpha=.4)
+        left, right = node.split_samples()
+        left_mean, right_mean = np.mean(y_train[left]), np.mean(y_train[right])
+    else:
+        means = shadow_tree.node_target_means()
+        left_mean = means[shadow_tree.children_left[node.id]]
+        right_mean = means[shadow_tree.children_right[node.id]]
     split = node.split()
-    ax.plot([overall_feature_range[0],split],[np.mean(left),np.mean(left)],'--', color='k', linewidth=1)
+    ax.plot([overall_feature_range[0],split],[left_mean,left_mean],'--', color='k', linewidth=1)
     ax.plot([split,split],[*y_range],'--', color='k', linewidth=1)
-    ax.plot([split,overall_feature_range[1]],[np.mean(right),np.mean(right)],'--', color='k', linewidth=1)
+    ax.plot([split,overall_feature_range[1]],[right_mean,right_mean],'--', color='k', linewidth=1)
 
     def wedge(ax,x,color):
         ymin, ymax = ax.get_ylim()
@@ -653,10 +1155,8 @@ def regr_split_viz(node: ShadowDecTreeNode,
     if highlight_node:
         wedge(ax, X[node.feature()], color=HIGHLIGHT_COLOR)
 
-    plt.tight_layout()
-    if filename is not None:
-        plt.savefig(filename, bbox_inches='tight', pad_inches=0)
-        plt.close()
+    fig.tight_layout()
+    return save_figure(fig, filename)
 
 
 def regr_leaf_viz(node : ShadowDecTreeNode,
@@ -666,17 +1166,37 @@ def regr_leaf_viz(node : ShadowDecTreeNode,
                   y_range=None,
                   precision=1,
                   label_fontsize: int = 9,
-                  ticks_fontsize: int = 8):
-    samples = node.samples()
-    y = y[samples]
+                  ticks_fontsize: int = 8,
+                  cache : FigureCache = None,
+                  max_scatter_samples : int = 5000):
+    shadow_tree = node.shadow_tree
+    # Without samples, only the mean and quantiles are known
+    summary = not shadow_tree.has_samples() or node.nsamples() > max_scatter_samples
+    if cache is not None and filename is not None:
+        if shadow_tree.has_samples():
+            data = (y[node.samples()],)
+        else:
+            data = (shadow_tree.node_target_means()[node.id], node.nsamples(),
+                    shadow_tree.leaf_target_quantiles(BOX_QUANTILES)[node.id])
+        # node.id seeds the jitter so it is part of the figure
+        key = FigureCache.key('regr_leaf_viz', node.id, *data, target_name, y_range,
+                              precision, label_fontsize, ticks_fontsize, summary)
+        return cache.render(key, filename,
+                            lambda f: regr_leaf_viz(node, y, target_name, f, y_range,
+                                                    precision, label_fontsize, ticks_fontsize,
+                                                    max_scatter_samples=max_scatter_samples))
+
+    if shadow_tree.has_samples():
+        y = y[node.samples()]
+        m = np.mean(y)
+    else:
+        m = shadow_tree.node_target_means()[node.id]
 
     figsize = (.75, .8)
 
-    fig, ax = plt.subplots(1, 1, figsize=figsize)
+    fig, ax = template_figure('regr_leaf', figsize, filename)
     ax.tick_params(colors=GREY)
 
-    m = np.mean(y)
-
     ax.set_ylim(y_range)
     ax.spines['top'].set_visible(False)
     ax.spines['right'].set_visible(False)
@@ -685,41 +1205,54 @@ def regr_leaf_viz(node : ShadowDecTreeNode,
     ax.set_xticks([])
     # ax.set_yticks(y_range)
 
-    ticklabelpad = plt.rcParams['xtick.major.pad']
-    ax.annotate(f"{target_name}={round(m,precision)}\nn={len(y)}",
+    ticklabelpad = matplotlib.rcParams['xtick.major.pad']
+    ax.annotate(f"{target_name}={round(m,precision)}\nn={node.nsamples()}",
                 xy=(.5, 0), xytext=(.5, -.5*ticklabelpad), ha='center', va='top',
                 xycoords='axes fraction', textcoords='offset points',
                 fontsize = label_fontsize, fontname = "Arial", color = GREY)
 
     ax.tick_params(axis='y', which='major', width=.3, labelcolor=GREY, labelsize=ticks_fontsize)
 
-    mu = .5
-    sigma = .08
-    X = np.random.normal(mu, sigma, size=len(y))
     ax.set_xlim(0, 1)
     alpha = .25
 
-    ax.scatter(X, y, s=5, c='#225ea8', alpha=alpha)
-    ax.plot([0,len(node.samples())],[m,m],'--', color=GREY, linewidth=1)
+    if summary:
+        # Too many points to scatter; summarize them with a box spanning the
+        # middle half, a line at the median and whiskers out to 5% and 95%
+        q5, q25, q50, q75, q95 = shadow_tree.leaf_target_quantiles(BOX_QUANTILES)[node.id]
+        ax.add_patch(patches.Rectangle((.3, q25), .4, q75-q25, facecolor='#225ea8',
+                                       alpha=alpha, edgecolor='none'))
+        ax.plot([.3, .7], [q50, q50], color='#225ea8', linewidth=1)
+        ax.plot([.5, .5], [q5, q25], color='#225ea8', linewidth=.5)
+        ax.plot([.5, .5], [q75, q95], color='#225ea8', linewidth=.5)
+    else:
+        mu = .5
+        sigma = .08
+        # jitter seeded by node so a figure comes out the same no matter which
+        # process draws it
+        X = np.random.RandomState(node.id).normal(mu, sigma, size=len(y))
+        ax.scatter(X, y, s=5, c='#225ea8', alpha=alpha)
+    ax.plot([0,node.nsamples()],[m,m],'--', color=GREY, linewidth=1)
 
-    plt.tight_layout()
-    if filename is not None:
-        plt.savefig(filename, bbox_inches='tight', pad_inches=0)
-        plt.close()
+    fig.tight_layout()
+    return save_figure(fig, filename)
 
 
 def draw_legend_boxes(shadow_tree, basefilename):
-    n_classes = shadow_tree.nclasses()
+    """
+    Draw the class legend boxes of a classifier's shadow_tree, as dtreeviz()
+    draws its legend, to files {basefilename}0.svg, {basefilename}1.svg...
+    one per class.
+    """
     class_values = shadow_tree.unique_target_values
-    color_values = color_blind_friendly_colors[n_classes]
-    colors = {v:color_values[i] for i,v in enumerate(class_values)}
-
-    for i, c in enumerate(class_values):
-        draw_colored_box(colors[c], f"{basefilename}{i}_{getpid()}.svg")
+    color_values = color_blind_friendly_colors[shadow_tree.nclasses()]
+    figures = [('legend', None, dict(color=color_values[i], filename=f"{basefilename}{i}.svg"))
+               for i in range(len(class_values))]
+    render_node_figures(shadow_tree, figures)
 
 
 def draw_colored_box(color,filename):
-    fig, ax = plt.subplots(1, 1, figsize=(.65, .5))
+    fig, ax = template_figure('colored_box', (.65, .5), filename)
 
     box1 = patches.Rectangle((0, 0), 2, 1, linewidth=1.2, edgecolor='grey',
                              facecolor=color)
@@ -732,9 +1265,8 @@ def draw_colored_box(color,filename):
     ax.xaxis.set_visible(False)
     ax.yaxis.set_visible(False)
 
-    plt.tight_layout()
-    plt.savefig(filename, bbox_inches='tight', pad_inches=0)
-    plt.close()
+    fig.tight_layout()
+    return save_figure(fig, filename)
 
 def draw_piechart(counts,size,colors,filename,label=None):
     n_nonzero = np.count_nonzero(counts)
@@ -743,7 +1275,7 @@ def draw_piechart(counts,size,colors,filename,label=None):
         counts = [counts[i]]
         colors = [colors[i]]
     tweak = size * .01
-    fig, ax = plt.subplots(1, 1, figsize=(size, size))
+    fig, ax = template_figure('piechart', (size, size), filename)
     ax.axis('equal')
     # ax.set_xlim(0 - tweak, size + tweak)
     # ax.set_ylim(0 - tweak, size + tweak)
@@ -766,9 +1298,322 @@ def draw_piechart(counts,size,colors,filename,label=None):
                 verticalalignment='top',
                 fontsize=9, color=GREY, fontname="Arial")
 
-    # plt.tight_layout()
-    plt.savefig(filename, bbox_inches='tight', pad_inches=0)
-    plt.close()
+    # fig.tight_layout()
+    return save_figure(fig, filename)
+
+
+# The svg backend: the same figures built directly as SVG elements from the
+# geometry, laid out like matplotlib does them, without matplotlib. Text is
+# left to the SVG viewer's font. They return the SVG text if filename is None.
+
+def class_split_svg(node: ShadowDecTreeNode,
+                    colors: Mapping[int, str],
+                    node_heights,
+                    filename: str = None,
+                    ticks_fontsize: int = 8,
+                    label_fontsize: int = 9,
+                    precision=1,
+                    histtype: ('bar', 'barstacked') = 'barstacked',
+                    X : np.array = None,
+                    highlight_node : bool = False):
+    height_range = (.5, 1.5)
+    h = prop_size(n=node_heights[node.id], counts=node_heights.values(), output_range=height_range)
+    shadow_tree = node.shadow_tree
+    class_values = shadow_tree.unique_target_values
+    nbins = get_num_bins(histtype, shadow_tree.nclasses())
+    bins = shadow_tree.feature_bins(node.feature(), nbins)
+    counts = shadow_tree.get_split_node_histograms(nbins)[node.id]
+
+    # bar geometry as hist() lays it out
+    width = np.diff(bins)
+    if histtype == 'barstacked':
+        tops = np.cumsum(counts, axis=1)
+        lefts = [bins[:-1]] * len(class_values)
+        width = [width] * len(class_values)
+    else:
+        tops = counts
+        lefts = [bins[:-1] + .1 * width + i * .8 * width / len(class_values) for i in range(len(class_values))]
+        width = [.8 * width / len(class_values)] * len(class_values)
+    ymax = tops.max()
+
+    fig = SVGFigure()
+    # the axes take the middle of a 3.3 x h inch figure
+    ax = Axes(fig, 0, 0, 3.3 * 72 * .775, h * 72 * .77,
+              shadow_tree.feature_range(node.feature()), (0, ymax * 1.05 or 1))
+    for i, cl in enumerate(class_values):
+        bar = counts[:, i] > 0
+        x0, x1 = ax.px(lefts[i][bar]), ax.px(lefts[i][bar] + width[i][bar])
+        y0, y1 = ax.py(tops[bar, i]), ax.py(tops[bar, i] - counts[bar, i])
+        fig.rects(x0, y0, x1 - x0, y1 - y0, colors[cl], stroke=GREY, stroke_width=.5)
+    ax.spines()
+    ax.xticks(ax.xlim, ticks_fontsize, 'black', GREY)
+    ax.yticks([0, ymax], ticks_fontsize, 'black', GREY)
+    ax.xlabel(node.feature_name(), label_fontsize, GREY)
+
+    def wedge(x, color):
+        th = 72 * .77 * .15 # .15 of the axes height per unit of h
+        tw = ax.width * .018
+        x = float(ax.px(x))
+        bottom = ax.y + ax.height
+        fig.polygon([(x, bottom + .1 * th), (x - tw, bottom + th), (x + tw, bottom + th)], color)
+        return bottom + 2 * th
+
+    baseline = wedge(node.split(), WEDGE_COLOR)
+    fig.text(float(ax.px(node.split())), baseline, f"{round(node.split(),precision)}",
+             ticks_fontsize, GREY, valign='baseline')
+    if highlight_node:
+        wedge(X[node.feature()], HIGHLIGHT_COLOR)
+    return fig.save(filename)
+
+
+def class_leaf_svg(node : ShadowDecTreeNode,
+                   colors : List[str],
+                   filename: str = None):
+    size = prop_size(node.nsamples(), counts=node.shadow_tree.leaf_sample_counts(),
+                     output_range=(1.01, 1.5))
+    size = np.sqrt(np.log(size))
+    return piechart_svg(node.class_counts(), size, colors, filename, label=f"n={node.nsamples()}")
+
+
+def regr_split_svg(node: ShadowDecTreeNode,
+                   target_name: str,
+                   filename: str = None,
+                   y_range=None,
+                   ticks_fontsize: int = 8,
+                   label_fontsize: int = 9,
+                   precision=1,
+                   X : np.array = None,
+                   highlight_node : bool = False,
+                   max_scatter_samples : int = 5000):
+    shadow_tree = node.shadow_tree
+    density = not shadow_tree.has_samples() or node.nsamples() > max_scatter_samples
+    xmin, xmax = overall_feature_range = shadow_tree.feature_range(node.feature())
+    xr = xmax - xmin
+    split = node.split()
+    xticks = list(overall_feature_range)
+    if split>xmin+.10*xr and split<xmax-.1*xr: # don't show split if too close to axis ends
+        xticks += [split]
+    isroot = node==shadow_tree.root
+
+    # tight_layout() fits axes 30pt high, and their labels, in a 2.5 inch wide figure
+    height = 30
+    yticks = auto_ticks(*y_range, np.clip(height // (2 * ticks_fontsize), 1, 9))
+    left = 7 + max(text_width(s, ticks_fontsize) for s in format_ticks(yticks))
+    if isroot:
+        left += 4 + 1.17 * label_fontsize
+    right = text_width(format_ticks(xticks)[1], ticks_fontsize) / 2
+    fig = SVGFigure()
+    ax = Axes(fig, 0, 0, 2.5 * 72 - 2 * 10.8 - left - right, height, overall_feature_range, y_range)
+
+    if density:
+        counts = shadow_tree.get_split_node_densities(DENSITY_BINS, y_range)[node.id]
+        shade = np.log1p(counts)
+        nonzero = counts > 0
+        if nonzero.any():
+            lo, hi = shade[nonzero].min(), shade[nonzero].max()
+            t = (shade - lo) / (hi - lo) if hi > lo else np.zeros_like(shade)
+            ny, nx = counts.shape
+            xs = ax.px(np.linspace(xmin, xmax, nx + 1))
+            ys = ax.py(np.linspace(*y_range, ny + 1))
+            rows, cols = np.nonzero(nonzero)
+            cell_colors = np.array(interpolate_colors('#d9e6f5', '#225ea8', t[rows, cols]))
+            for color in np.unique(cell_colors):
+                cells = cell_colors == color
+                r, c = rows[cells], cols[cells]
+                fig.rects(xs[c], ys[r + 1], xs[c + 1] - xs[c], ys[r] - ys[r + 1], color)
+    if shadow_tree.has_samples():
+        X_feature = shadow_tree.X_train[node.samples(), node.feature()]
+        y = shadow_tree.y_train[node.samples()]
+        if not density:
+            px, py = ax.px(X_feature), ax.py(y)
+            inside = (px >= ax.x) & (px <= ax.x + ax.width) & (py >= ax.y) & (py <= ax.y + ax.height)
+            fig.circles(px[inside], py[inside], np.sqrt(5) / 2, '#225ea8', opacity=.4, edge_width=1)
+        left_samples, right_samples = node.split_samples()
+        left_mean, right_mean = np.mean(y[left_samples]), np.mean(y[right_samples])
+    else:
+        means = shadow_tree.node_target_means()
+        left_mean = means[shadow_tree.children_left[node.id]]
+        right_mean = means[shadow_tree.children_right[node.id]]
+    sx = float(ax.px(split))
+    fig.line(ax.x, float(ax.py(left_mean)), sx, float(ax.py(left_mean)), 'black', dashed=True)
+    fig.line(sx, ax.y, sx, ax.y + ax.height, 'black', dashed=True)
+    fig.line(sx, float(ax.py(right_mean)), ax.x + ax.width, float(ax.py(right_mean)), 'black', dashed=True)
+
+    ax.spines()
+    ax.xticks(xticks, ticks_fontsize, GREY, GREY)
+    ax.yticks(yticks, ticks_fontsize, GREY, GREY)
+    ax.xlabel(node.feature_name(), label_fontsize, GREY)
+    if isroot:
+        ax.ylabel(target_name, label_fontsize, GREY)
+
+    def wedge(x, color):
+        th = ax.height * .1
+        tw = ax.width * .018
+        x = float(ax.px(x))
+        bottom = ax.y + ax.height
+        fig.polygon([(x, bottom), (x - tw, bottom + th), (x + tw, bottom + th)], color)
+
+    wedge(split, WEDGE_COLOR)
+    if highlight_node:
+        wedge(X[node.feature()], HIGHLIGHT_COLOR)
+    return fig.save(filename)
+
+
+def regr_leaf_svg(node : ShadowDecTreeNode,
+                  target_name,
+                  filename:str=None,
+                  y_range=None,
+                  precision=1,
+                  label_fontsize: int = 9,
+                  ticks_fontsize: int = 8,
+                  max_scatter_samples : int = 5000):
+    shadow_tree = node.shadow_tree
+    summary = not shadow_tree.has_samples() or node.nsamples() > max_scatter_samples
+    if shadow_tree.has_samples():
+        y = shadow_tree.y_train[node.samples()]
+        m = np.mean(y)
+    else:
+        m = shadow_tree.node_target_means()[node.id]
+
+    # tight_layout() fits axes 14pt high, and their labels, in a .75 inch wide figure
+    yticks = auto_ticks(*y_range, 1)
+    left = 7 + max(text_width(s, ticks_fontsize) for s in format_ticks(yticks))
+    fig = SVGFigure()
+    ax = Axes(fig, 0, 0, max(.75 * 72 - 2 * 10.8 - left, 4), 14, (0, 1), y_range)
+
+    alpha = .25
+    if summary:
+        q5, q25, q50, q75, q95 = ax.py(shadow_tree.leaf_target_quantiles(BOX_QUANTILES)[node.id])
+        x3, x5, x7 = ax.px([.3, .5, .7])
+        fig.rect(x3, q75, x7 - x3, q25 - q75, '#225ea8', opacity=alpha)
+        fig.line(x3, q50, x7, q50, '#225ea8')
+        fig.line(x5, q5, x5, q25, '#225ea8', .5)
+        fig.line(x5, q75, x5, q95, '#225ea8', .5)
+    else:
+        # the same jitter as regr_leaf_viz()
+        jitter = np.random.RandomState(node.id).normal(.5, .08, size=len(y))
+        px, py = ax.px(jitter), ax.py(y)
+        inside = (px >= ax.x) & (px <= ax.x + ax.width) & (py >= ax.y) & (py <= ax.y + ax.height)
+        fig.circles(px[inside], py[inside], np.sqrt(5) / 2, '#225ea8', opacity=alpha, edge_width=1)
+    fig.line(ax.x, float(ax.py(m)), ax.x + ax.width, float(ax.py(m)), GREY, dashed=True)
+
+    ax.spines(bottom=False)
+    ax.yticks(yticks, ticks_fontsize, GREY, GREY)
+    ticklabelpad = 3.5
+    top = ax.y + ax.height + .5 * ticklabelpad
+    for i, line in enumerate([f"{target_name}={round(m,precision)}", f"n={node.nsamples()}"]):
+        fig.text(ax.x + ax.width / 2, top + i * 1.2 * label_fontsize, line, label_fontsize, GREY)
+    return fig.save(filename)
+
+
+def colored_box_svg(color, filename=None):
+    fig = SVGFigure()
+    fig.rect(0, 0, 25.2, 14.4, color, stroke='grey', stroke_width=1.2)
+    return fig.save(filename)
+
+
+def piechart_svg(counts, size, colors, filename=None, label=None):
+    d = size * 72 * .856 # what's left of the size x size inch figure
+    r = d / 2
+    fig = SVGFigure()
+    nonzero = np.nonzero(counts)[0]
+    if len(nonzero) == 1:
+        fig.path(f"M{fmt(d)},{fmt(r)}A{fmt(r)},{fmt(r)} 0 1,0 0,{fmt(r)}A{fmt(r)},{fmt(r)} 0 1,0 {fmt(d)},{fmt(r)}Z",
+                 (0, 0, d, d), colors[nonzero[0]], stroke=GREY, stroke_width=.5)
+    else:
+        # counterclockwise from 3 o'clock, like pie()
+        angles = 2 * np.pi * np.concatenate([[0], np.cumsum(counts)]) / np.sum(counts)
+        for i in nonzero:
+            a0, a1 = angles[i], angles[i+1]
+            large = 1 if a1 - a0 > np.pi else 0
+            fig.path(f"M{fmt(r)},{fmt(r)}L{fmt(r + r*np.cos(a0))},{fmt(r - r*np.sin(a0))}"
+                     f"A{fmt(r)},{fmt(r)} 0 {large},0 {fmt(r + r*np.cos(a1))},{fmt(r - r*np.sin(a1))}Z",
+                     (0, 0, d, d), colors[i], stroke=GREY, stroke_width=.5)
+    if label is not None:
+        fig.text(r, d * 1.03, label, 9, GREY)
+    return fig.save(filename)
+
+
+# How to draw each kind of figure in render_node_figures()
+NODE_FIGURES = {
+    'class_split': lambda node, **kwargs: class_split_viz(node, node.shadow_tree.X_train, node.shadow_tree.y_train, **kwargs),
+    'regr_split':  lambda node, **kwargs: regr_split_viz(node, node.shadow_tree.X_train, node.shadow_tree.y_train, **kwargs),
+    'class_leaf':  class_leaf_viz,
+    'regr_leaf':   lambda node, **kwargs: regr_leaf_viz(node, node.shadow_tree.y_train, **kwargs),
+    'legend':      draw_colored_box,
+    'class_split_svg': class_split_svg,
+    'regr_split_svg':  regr_split_svg,
+    'class_leaf_svg':  class_leaf_svg,
+    'regr_leaf_svg':   regr_leaf_svg,
+    'legend_svg':      colored_box_svg
+}
+
+
+def new_figure(figsize):
+    """
+    Return a new (fig, ax) pair. The figure gets its own canvas rather than
+    going through pyplot, whose global figure manager isn't thread safe.
+    """
+    fig = Figure(figsize=figsize)
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(1, 1, 1)
+    return fig, ax
+
+
+def template_figure(kind, figsize, filename):
+    """
+    Return a (fig, ax) pair to draw a figure of kind into and save to
+    filename with save_figure(), like new_figure(figsize). Making a figure
+    and its axes costs about as much as drawing a simple node, so each
+    thread keeps one figure of each kind around and save_figure() puts it
+    back as new_figure() would return it: added artists removed, labels,
+    limits, autoscaling, color cycle and subplot layout reset. Every use of
+    a kind must set up the axes the same way, leaving only what the reset
+    undoes to vary. If filename is None the caller keeps the figure, so it
+    gets a new one.
+    """
+    if filename is None:
+        return new_figure(figsize)
+    # Taken out while in use, so a drawing that fails just loses its figure
+    fig, ax = vars(_figure_templates).pop(kind, None) or new_figure(figsize)
+    fig.set_size_inches(figsize)
+    fig.template_kind = kind
+    return fig, ax
+
+
+_figure_templates = threading.local() # kind -> (fig, ax) for template_figure()
+
+
+def reset_template_figure(fig):
+    "Restore a template_figure() figure, once saved, and make it available again"
+    ax = fig.axes[0]
+    for artist in [*ax.lines, *ax.patches, *ax.texts, *ax.images, *ax.collections,
+                   *ax.tables, *ax.artists]:
+        artist.remove()
+    if ax.legend_ is not None:
+        ax.legend_.remove()
+    ax.containers.clear() # the bar and hist groups of the patches just removed
+    ax.set_xlabel('')
+    ax.set_ylabel('')
+    ax.relim()
+    ax.ignore_existing_data_limits = True
+    ax.set_autoscale_on(True)
+    ax.set_prop_cycle(None)
+    fig.subplots_adjust(**{k: matplotlib.rcParams[f'figure.subplot.{k}']
+                           for k in ('left', 'right', 'bottom', 'top', 'wspace', 'hspace')})
+    vars(_figure_templates)[fig.template_kind] = (fig, ax)
+
+
+def save_figure(fig, filename):
+    """
+    Save fig as SVG to filename, a file name or file object. If filename is
+    None, return fig instead so a notebook can display it.
+    """
+    if filename is None:
+        return fig
+    fig.savefig(filename, bbox_inches='tight', pad_inches=0, format='svg')
+    if hasattr(fig, 'template_kind'):
+        reset_template_figure(fig)
 
 
 def prop_size(n, counts, output_range = (0.00, 0.3)):
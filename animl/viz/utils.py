@@ -1,5 +1,10 @@
+import itertools
+import re
 import xml.etree.cElementTree as ET
 
+SVG_NS = "http://www.w3.org/2000/svg"
+XLINK_NS = "http://www.w3.org/1999/xlink"
+
 def inline_svg_images(svg) -> str:
     """
     Inline IMAGE tag refs in graphviz/dot -> SVG generated files.
@@ -65,6 +70,157 @@ def inline_svg_images(svg) -> str:
     return xml_str
 
 
+def splice_svg_images(svg, images) -> str:
+    """
+    Replace placeholder cells in graphviz/dot -> SVG output with in-memory
+    SVG images. A placeholder is an HTML-label table cell with a unique
+    bgcolor, which graphviz emits as a filled polygon:
+
+    <polygon fill="#fe0003" stroke="transparent" points="76,-80 76,-4 125,-4 125,-80 76,-80"/>
+
+    Each such polygon is swapped for the root svg tag of images["#fe0003"]
+    positioned and scaled to the polygon's bounding box.
+
+    :param svg: SVG string generated by graphviz.
+    :param images: Mapping from placeholder fill color to SVG text.
+    :return: svg with placeholders replaced by the images.
+    """
+    ns = {"svg": "http://www.w3.org/2000/svg"}
+    root = ET.fromstring(svg)
+    tree = ET.ElementTree(root)
+    parent_map = {c: p for p in tree.iter() for c in p}
+
+    for polygon in tree.findall(".//svg:polygon", ns):
+        fill = polygon.attrib.get("fill", "").lower()
+        if fill not in images:
+            continue
+        points = [tuple(map(float, p.split(','))) for p in polygon.attrib["points"].split()]
+        xs, ys = [p[0] for p in points], [p[1] for p in points]
+        imgroot = ET.fromstring(images[fill])
+        imgroot.attrib["x"] = str(min(xs))
+        imgroot.attrib["y"] = str(min(ys))
+        imgroot.attrib["width"] = str(max(xs) - min(xs))
+        imgroot.attrib["height"] = str(max(ys) - min(ys))
+        imgroot.attrib["preserveAspectRatio"] = "xMinYMin meet"
+        p = parent_map[polygon]
+        p.insert(list(p).index(polygon), imgroot)
+        p.remove(polygon)
+
+    ET.register_namespace('', "http://www.w3.org/2000/svg")
+    ET.register_namespace('xlink', "http://www.w3.org/1999/xlink")
+    xml_str = ET.tostring(root).decode()
+    return xml_str
+
+
+def optimize_svg(svg) -> str:
+    """
+    Shrink an SVG document holding nested svg images, such as
+    splice_svg_images() and inline_svg_images() produce. Every matplotlib
+    figure brings its own <defs> of glyph paths, markers, clip paths and
+    styles, mostly the same ones, with ids that can collide between figures:
+
+    <defs><path id="DejaVuSans-30" d="M 2034 4250 ..."/></defs>
+    ...
+    <use xlink:href="#DejaVuSans-30"/>
+
+    Identical definitions are merged into a single <defs> block at the top of
+    the document under fresh ids and the href="#..." and url(#...) references
+    to them rewritten. Ids no reference points at are dropped from the
+    images, as are <metadata> elements and whitespace between tags.
+
+    :param svg: SVG string with nested svg images.
+    :return: svg with the same drawing but shared defs.
+    """
+    root = ET.fromstring(svg)
+    parent_map = {c: p for p in root.iter() for c in p}
+
+    for metadata in list(root.iter(f"{{{SVG_NS}}}metadata")):
+        parent_map[metadata].remove(metadata)
+
+    taken = {e.attrib["id"] for e in root.iter() if "id" in e.attrib}
+    counter = itertools.count()
+    def fresh_id():
+        id = f"d{next(counter)}"
+        while id in taken:
+            id = f"d{next(counter)}"
+        return id
+
+    shared = ET.Element(f"{{{SVG_NS}}}defs")
+    signatures = {} # def without its id -> its shared id
+    images = [e for e in root.iter(f"{{{SVG_NS}}}svg") if e is not root]
+    for image in images:
+        referenced = {ref for e in image.iter() for ref in _svg_refs(e)}
+        ids = {} # this image's ids -> shared/fresh ids
+        for defs in list(image.iter(f"{{{SVG_NS}}}defs")):
+            for d in list(defs):
+                _rename_svg_refs(d, ids)
+                id = d.attrib.pop("id", None)
+                d.tail = None
+                signature = ET.tostring(d)
+                if signature not in signatures:
+                    signatures[signature] = fresh_id() if id is not None else None
+                    if id is not None:
+                        d.attrib["id"] = signatures[signature]
+                    shared.append(d)
+                if id is not None:
+                    ids[id] = signatures[signature]
+            parent_map[defs].remove(defs)
+        for e in image.iter():
+            id = e.attrib.pop("id", None)
+            if id in referenced and id not in ids:
+                ids[id] = e.attrib["id"] = fresh_id()
+        for e in image.iter():
+            _rename_svg_refs(e, ids)
+
+    if len(shared):
+        root.insert(0, shared)
+
+    for e in root.iter():
+        if e.tag in {f"{{{SVG_NS}}}text", f"{{{SVG_NS}}}tspan"}:
+            continue
+        if len(e) and e.text is not None and e.text.isspace():
+            e.text = None
+        for c in e:
+            if c.tail is not None and c.tail.isspace():
+                c.tail = None
+
+    ET.register_namespace('', SVG_NS)
+    ET.register_namespace('xlink', XLINK_NS)
+    xml_str = ET.tostring(root).decode()
+    return xml_str
+
+
+def _svg_refs(e):
+    "Yield the ids that element e refers to with href=\"#id\" or url(#id)"
+    for k, v in e.attrib.items():
+        if k in {f"{{{XLINK_NS}}}href", "href"} and v.startswith("#"):
+            yield v[1:]
+        else:
+            yield from re.findall(r"url\(#([^)]+)\)", v)
+
+
+def _rename_svg_refs(e, ids):
+    "Rewrite element e's href=\"#id\" and url(#id) references using mapping ids"
+    for k, v in e.attrib.items():
+        if k in {f"{{{XLINK_NS}}}href", "href"} and v.startswith("#"):
+            e.attrib[k] = "#" + ids.get(v[1:], v[1:])
+        elif "url(#" in v:
+            e.attrib[k] = re.sub(r"url\(#([^)]+)\)", lambda m: f"url(#{ids.get(m.group(1), m.group(1))})", v)
+
+
+def svg_size(svg) -> (float, float):
+    """
+    Return (width, height) in points of an SVG string such as matplotlib
+    generates:
+
+    <svg height="80.826687pt" version="1.1" viewBox="0 0 49.008672 80.826687" width="49.008672pt" ...>
+    """
+    svgtag = re.search(r'<svg\s[^>]*>', svg).group(0)
+    width = re.search(r'\swidth="([0-9.]+)(pt)?"', svgtag).group(1)
+    height = re.search(r'\sheight="([0-9.]+)(pt)?"', svgtag).group(1)
+    return float(width), float(height)
+
+
 def get_SVG_shape(filename):
     """
     Sample line from SVG file from which we can get w,h:
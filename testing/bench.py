@@ -0,0 +1,310 @@
+import numpy as np
+import argparse
+import inspect
+import json
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import graphviz
+import matplotlib
+import sklearn
+from sklearn import tree
+
+from animl.trees import *
+from animl.viz.trees import *
+from animl.viz.utils import inline_svg_images, splice_svg_images, optimize_svg
+
+"""
+Time each stage of the visualization pipeline on the viz_* scenarios of
+gen_samples.py and on synthetic datasets of varying size, and write the
+results as JSON so runs on different commits can be compared. The
+gen_samples.py scenarios are skipped, with a warning, if it won't import
+with the installed sklearn.
+
+Run with working directory as main animl dir, like gen_samples.py:
+
+    $ python testing/bench.py -o before.json
+    $ git checkout ...
+    $ python testing/bench.py -o after.json
+    $ python testing/bench.py --compare before.json after.json
+
+Each stage is timed on its own, starting from the results of the stages
+before it, and the best of --repeat runs is reported:
+
+    build       ShadowDecTree(), walking the tree structure
+    membership  ShadowDecTree.build_samples(), running X_train down the tree
+    stats       per-node histograms (classifiers) or densities, means and
+                quantiles (regressors)
+    figures     node, leaf and legend figures, drawn with --backend
+    dot         DOT generation, timed by re-running viz_shadow_tree() with
+                every figure reused from the previous run
+    layout      graphviz layout to SVG (dot -Tsvg)
+    inline      splicing the node figures into graphviz's SVG and optimize_svg()
+    convert     DTreeViz.save() to PNG (dot -Tpng with the figures)
+
+The last three need graphviz's dot; without it they are reported as null.
+
+The results also have the time to import animl.trees and animl.viz.trees in
+a fresh interpreter. --check-imports instead fails if importing either one
+loads a module in HEAVY_MODULES, or takes longer than --max-import-ms:
+
+    $ python testing/bench.py --check-imports
+"""
+
+STAGES = ('build', 'membership', 'stats', 'figures', 'dot', 'layout', 'inline', 'convert')
+
+# Modules that importing animl mustn't drag in; functions needing them import them
+HEAVY_MODULES = ('IPython', 'graphviz', 'pandas', 'sklearn', 'scipy', 'matplotlib.pyplot')
+IMPORTED_MODULES = ('animl.trees', 'animl.viz.trees')
+
+
+def synthetic(rows, features, classes, depth, random_state=666):
+    """
+    Return (model, X, y, feature_names, class_names) for a tree of the given
+    depth fit to rows random samples with features features. classes is the
+    number of classes, or 0 for regression.
+    """
+    rng = np.random.RandomState(random_state)
+    X = rng.normal(size=(rows, features))
+    signal = X[:, :min(features, 5)].sum(axis=1) + rng.normal(scale=.5, size=rows)
+    feature_names = [f"f{i}" for i in range(features)]
+    if classes == 0:
+        model = tree.DecisionTreeRegressor(max_depth=depth, random_state=random_state)
+        y = signal * 10 + 50
+        class_names = None
+    else:
+        model = tree.DecisionTreeClassifier(max_depth=depth, random_state=random_state)
+        edges = np.quantile(signal, np.linspace(0, 1, classes + 1)[1:-1])
+        y = np.searchsorted(edges, signal)
+        class_names = [f"class{i}" for i in range(classes)]
+    model.fit(X, y)
+    return model, X, y, feature_names, class_names
+
+
+def synthetic_scenarios(rows, features, classes, depths):
+    for n in rows:
+        for p in features:
+            for k in classes:
+                for d in depths:
+                    name = f"synthetic-rows{n}-features{p}-classes{k}-depth{d}"
+                    yield name, lambda n=n, p=p, k=k, d=d: synthetic(n, p, k, d)
+
+
+def sample_scenarios(depths):
+    """
+    Yield the viz_* scenarios of gen_samples.py at each depth. The model and
+    training data are taken from the visualization each one returns. If
+    gen_samples.py can't be imported, for instance because the installed
+    sklearn no longer has one of its dataset loaders, warn and yield none.
+    """
+    try:
+        import gen_samples # needs its datasets and their loaders; only import if asked
+    except ImportError as e:
+        print(f"warning: skipping the gen_samples.py scenarios: {e}", file=sys.stderr)
+        return
+    for name, f in inspect.getmembers(gen_samples, inspect.isfunction):
+        if not name.startswith('viz_') or inspect.getmodule(f) != gen_samples:
+            continue
+        for d in depths:
+            def setup(f=f, d=d):
+                shadow_tree = f(max_depth=d).shadow_tree
+                return (shadow_tree.tree_model, shadow_tree.X_train, shadow_tree.y_train,
+                        shadow_tree.feature_names, shadow_tree.class_names)
+            yield f"{name[len('viz_'):]}-depth{d}", setup
+
+
+def time_stages(model, X, y, feature_names, class_names, in_memory=False, backend='matplotlib'):
+    "Return a dictionary mapping each stage name to its wall time in seconds"
+    times = {}
+    with_dot = shutil.which('dot') is not None
+
+    start = time.perf_counter()
+    shadow_tree = ShadowDecTree(model, X, y, feature_names=feature_names, class_names=class_names)
+    times['build'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    shadow_tree.build_samples()
+    times['membership'] = time.perf_counter() - start
+
+    # the statistics viz_shadow_tree() asks for, with its defaults
+    start = time.perf_counter()
+    if shadow_tree.isclassifier():
+        shadow_tree.get_split_node_heights(nbins=get_num_bins('barstacked', shadow_tree.nclasses()))
+    else:
+        y_range = (np.min(y)*1.03, np.max(y)*1.03)
+        shadow_tree.node_target_means()
+        shadow_tree.get_split_node_densities(DENSITY_BINS, y_range)
+        shadow_tree.leaf_target_quantiles(BOX_QUANTILES)
+    times['stats'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    viz = viz_shadow_tree(shadow_tree, 'y', in_memory=in_memory, backend=backend)
+    figures_and_dot = time.perf_counter() - start
+    start = time.perf_counter()
+    viz_shadow_tree(shadow_tree, 'y', in_memory=in_memory, backend=backend, previous=viz)
+    times['dot'] = time.perf_counter() - start
+    times['figures'] = max(figures_and_dot - times['dot'], 0.0)
+
+    times['layout'] = times['inline'] = times['convert'] = None
+    if with_dot:
+        start = time.perf_counter()
+        svg = graphviz.Source(viz.dot).pipe(format='svg').decode('utf-8')
+        times['layout'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        if viz.images is not None:
+            optimize_svg(splice_svg_images(svg, viz.images))
+        else:
+            optimize_svg(inline_svg_images(svg))
+        times['inline'] = time.perf_counter() - start
+
+        with tempfile.TemporaryDirectory() as tmp:
+            start = time.perf_counter()
+            viz.save(f"{tmp}/tree.png")
+            times['convert'] = time.perf_counter() - start
+    return times
+
+
+def n_classes(model):
+    "Return the number of classes model predicts, 0 for a regressor"
+    return model.tree_.n_classes[0] if model.tree_.n_classes[0] > 1 else 0
+
+
+def run(scenarios, repeat=3, in_memory=False, backend='matplotlib'):
+    results = []
+    for name, setup in scenarios:
+        model, X, y, feature_names, class_names = setup()
+        runs = [time_stages(model, X, y, feature_names, class_names, in_memory=in_memory, backend=backend)
+                for _ in range(repeat)]
+        best = {}
+        for stage in STAGES:
+            times = [r[stage] for r in runs if r[stage] is not None]
+            best[stage] = min(times) if times else None
+        result = dict(scenario=name,
+                      rows=len(X),
+                      features=X.shape[1],
+                      classes=int(n_classes(model)),
+                      depth=int(model.get_depth()),
+                      nodes=int(model.tree_.node_count),
+                      seconds=best,
+                      runs=runs)
+        print(f"{name:55s} " + " ".join(f"{stage}={t:.3f}" for stage, t in best.items() if t is not None),
+              file=sys.stderr)
+        results.append(result)
+    return results
+
+
+def import_time(module, repeat=5):
+    """
+    Return (seconds, heavy) where seconds is the best time over repeat fresh
+    interpreters to import module and heavy lists the HEAVY_MODULES that
+    importing it loaded.
+    """
+    code = f"""
+import sys, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(seconds, *[m for m in {HEAVY_MODULES!r} if m in sys.modules])
+"""
+    best, heavy = None, []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, "-c", code], capture_output=True,
+                             text=True, check=True).stdout.split()
+        seconds, heavy = float(out[0]), out[1:]
+        best = seconds if best is None else min(best, seconds)
+    return best, heavy
+
+
+def check_imports(max_ms):
+    "Print import times of IMPORTED_MODULES and return whether they are all within limits"
+    ok = True
+    for module in IMPORTED_MODULES:
+        seconds, heavy = import_time(module)
+        problems = []
+        if heavy:
+            problems.append(f"loads {', '.join(heavy)}")
+        if max_ms is not None and seconds * 1000 > max_ms:
+            problems.append(f"slower than {max_ms}ms")
+        print(f"{module:20s} {seconds*1000:8.1f}ms {'; '.join(problems) or 'ok'}")
+        ok = ok and not problems
+    return ok
+
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return dict(commit=commit,
+                python=platform.python_version(),
+                platform=platform.platform(),
+                numpy=np.__version__,
+                sklearn=sklearn.__version__,
+                matplotlib=matplotlib.__version__,
+                graphviz=shutil.which('dot') is not None,
+                time=time.strftime("%Y-%m-%dT%H:%M:%S"))
+
+
+def compare(before_filename, after_filename):
+    "Print after/before time ratios of each stage of the scenarios in both files"
+    with open(before_filename) as f:
+        before = {r['scenario']: r for r in json.load(f)['results']}
+    with open(after_filename) as f:
+        after = {r['scenario']: r for r in json.load(f)['results']}
+    print(f"{'scenario':55s} " + " ".join(f"{stage:>10s}" for stage in STAGES))
+    for name, r in after.items():
+        if name not in before:
+            continue
+        ratios = []
+        for stage in STAGES:
+            b, a = before[name]['seconds'][stage], r['seconds'][stage]
+            ratios.append(f"{a/b:10.2f}" if a is not None and b else f"{'-':>10s}")
+        print(f"{name:55s} " + " ".join(ratios))
+
+
+def ints(s):
+    return [int(v) for v in s.split(',')]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Time the stages of the dtreeviz pipeline")
+    parser.add_argument('-o', '--output', default="bench.json", help="JSON results file")
+    parser.add_argument('--repeat', type=int, default=3, help="runs per scenario; the best is reported")
+    parser.add_argument('--rows', type=ints, default=[1000, 100000])
+    parser.add_argument('--features', type=ints, default=[10, 100])
+    parser.add_argument('--classes', type=ints, default=[0, 2, 5], help="0 means regression")
+    parser.add_argument('--depths', type=ints, default=[3, 6])
+    parser.add_argument('--sample-depths', type=ints, default=[2, 4],
+                        help="depths for the gen_samples.py scenarios")
+    parser.add_argument('--no-samples', action='store_true', help="skip the gen_samples.py scenarios")
+    parser.add_argument('--in-memory', action='store_true', help="render figures with in_memory=True")
+    parser.add_argument('--backend', choices=['matplotlib', 'svg'], default='matplotlib',
+                        help="how to draw the node figures")
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'),
+                        help="compare two results files instead of running")
+    parser.add_argument('--check-imports', action='store_true',
+                        help="check what importing animl costs instead of running")
+    parser.add_argument('--max-import-ms', type=float, default=None,
+                        help="with --check-imports, fail on imports slower than this")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        sys.exit(0)
+    if args.check_imports:
+        sys.exit(0 if check_imports(args.max_import_ms) else 1)
+
+    scenarios = list(synthetic_scenarios(args.rows, args.features, args.classes, args.depths))
+    if not args.no_samples:
+        scenarios += list(sample_scenarios(args.sample_depths))
+    results = run(scenarios, repeat=args.repeat, in_memory=args.in_memory, backend=args.backend)
+    with open(args.output, "w") as f:
+        imports = {module: import_time(module)[0] for module in IMPORTED_MODULES}
+        json.dump(dict(environment=environment(), stages=STAGES, results=results,
+                       imports=imports, backend=args.backend), f, indent=2)
+    print(f"wrote {args.output}", file=sys.stderr)
@@ -0,0 +1,170 @@
+import numpy as np
+import argparse
+import os
+import re
+import matplotlib
+from sklearn import tree
+from sklearn.datasets import load_iris, load_diabetes
+
+from animl.trees import *
+from animl.viz.trees import *
+from animl.viz.utils import splice_svg_images, optimize_svg
+
+"""
+Check that the fast paths of animl give the same results as the simple
+ones they replace, with plain asserts so that a failure points at the
+case that broke:
+
+    samples     lazy ShadowDecTree.samples_of() vs sklearn's decision_path()
+                and vs build_samples()
+    scan        ShadowDecTree.scan() in chunks, in worker processes and from
+                an iterator of chunks vs a single pass; list X_train
+    summarize   statistics gathered by summarize() vs those from the full
+                sample index; dtreeviz(summarize=True) with n_jobs > 1
+    predict     ShadowDecTree.predict_batch() vs predict(), row by row
+    optimize    optimize_svg() leaves no id referenced but not defined, and
+                no id defined twice
+
+Run with working directory as main animl dir, like gen_samples.py:
+
+    $ python testing/check_equivalences.py
+    $ python testing/check_equivalences.py samples predict
+"""
+
+# Ids svg figures made in different runs are compared by
+matplotlib.rcParams['svg.hashsalt'] = 'animl'
+os.environ.setdefault('SOURCE_DATE_EPOCH', '0')
+
+
+def models(max_depth=5):
+    """
+    Yield (model, X, y, feature_names, class_names) for a classifier and a
+    regressor. Features are rounded so that many values fall exactly on
+    split thresholds, where float32 and float64 comparisons could disagree.
+    """
+    iris = load_iris()
+    diabetes = load_diabetes()
+    for data, model, class_names in [(iris, tree.DecisionTreeClassifier, ["setosa", "versicolor", "virginica"]),
+                                     (diabetes, tree.DecisionTreeRegressor, None)]:
+        X = np.round(data.data, 2)
+        m = model(max_depth=max_depth, random_state=666).fit(X, data.target)
+        yield m, X, data.target, list(data.feature_names), class_names
+
+
+def check_samples():
+    for m, X, y, feature_names, class_names in models():
+        paths = m.decision_path(X).tocsc()
+        lazy = ShadowDecTree(m, X, y, feature_names=feature_names, class_names=class_names)
+        for node_id in range(m.tree_.node_count):
+            expected = paths.indices[paths.indptr[node_id]:paths.indptr[node_id + 1]]
+            assert np.array_equal(np.sort(lazy.samples_of(node_id)), expected), node_id
+        full = ShadowDecTree(m, X, y, feature_names=feature_names, class_names=class_names)
+        full.build_samples()
+        assert np.array_equal(full.sample_index, paths.indices)
+        assert np.array_equal(full.sample_offsets, paths.indptr)
+        assert np.array_equal(lazy.sample_counts, full.sample_counts)
+
+
+def check_scan():
+    for m, X, y, feature_names, class_names in models():
+        index, offsets, feature_min, feature_max = ShadowDecTree.scan(m, X, chunk_size=len(X))
+        assert np.array_equal(feature_min, X.min(axis=0)) and np.array_equal(feature_max, X.max(axis=0))
+        chunks = lambda: (X[i:i + 37] for i in range(0, len(X), 37))
+        for data, kwargs in [(X, dict(chunk_size=37)),
+                             (X, dict(chunk_size=37, n_jobs=2)),
+                             (X, dict(chunk_size=37, n_jobs=-1)),
+                             (X.tolist(), dict(chunk_size=37)),
+                             (chunks(), {}),
+                             (chunks(), dict(n_jobs=2))]:
+            result = ShadowDecTree.scan(m, data, **kwargs)
+            for a, b in zip(result, (index, offsets, feature_min, feature_max)):
+                assert np.array_equal(a, b), kwargs
+
+        for X_train in [X.tolist(), chunks()]:
+            t = ShadowDecTree(m, X_train, y, feature_names=feature_names, class_names=class_names)
+            assert np.array_equal(t.X_train, X)
+            t.build_samples()
+            assert np.array_equal(t.sample_index, index) and np.array_equal(t.sample_offsets, offsets)
+
+
+def check_summarize():
+    for m, X, y, feature_names, class_names in models(max_depth=8):
+        full = ShadowDecTree(m, X, y, feature_names=feature_names, class_names=class_names)
+        full.build_samples()
+        summarized = ShadowDecTree(m, X, y, feature_names=feature_names, class_names=class_names)
+        y_range = (np.min(y)*1.03, np.max(y)*1.03)
+        summarized.summarize(histogram_bins=[10], density_bins=DENSITY_BINS, y_range=y_range,
+                             quantiles=BOX_QUANTILES)
+        assert not summarized.has_samples()
+        assert np.array_equal(summarized.sample_counts, full.sample_counts)
+        if summarized.isclassifier():
+            a, b = summarized.get_split_node_histograms(10), full.get_split_node_histograms(10)
+            assert a.keys() == b.keys() and all(np.array_equal(a[k], b[k]) for k in b)
+        else:
+            assert np.allclose(summarized.node_target_means(), full.node_target_means())
+            a = summarized.get_split_node_densities(DENSITY_BINS, y_range)
+            b = full.get_split_node_densities(DENSITY_BINS, y_range)
+            assert a.keys() == b.keys() and all(np.array_equal(a[k], b[k]) for k in b)
+            a, b = summarized.leaf_target_quantiles(BOX_QUANTILES), full.leaf_target_quantiles(BOX_QUANTILES)
+            assert a.keys() == b.keys() and all(np.allclose(a[k], b[k], equal_nan=True) for k in b)
+
+        for backend in ['matplotlib', 'svg']:
+            images = [dtreeviz(m, X, y, feature_names, 'target', class_names=class_names,
+                               summarize=True, in_memory=True, backend=backend, n_jobs=n_jobs).images
+                      for n_jobs in [1, 2]]
+            assert images[0] == images[1], backend
+
+
+def check_predict():
+    for m, X, y, feature_names, class_names in models():
+        t = ShadowDecTree(m, X, y, feature_names=feature_names, class_names=class_names)
+        predictions, leaf_ids, paths = t.predict_batch(X)
+        for x, prediction, leaf_id, path in zip(X, predictions, leaf_ids, paths):
+            expected, nodes = t.predict(x)
+            assert prediction == expected
+            assert leaf_id == nodes[-1].id
+            assert list(path[path >= 0]) == [node.id for node in nodes]
+            assert np.all(path[len(nodes):] == -1)
+
+
+def fake_layout(images) -> str:
+    "Return SVG with a placeholder polygon per image, as graphviz draws for DTreeViz.svg()"
+    nodes = "".join(f'<g id="node{i}" class="node"><title>n{i}</title>'
+                    f'<polygon fill="{color}" stroke="transparent" '
+                    f'points="{i*60},0 {i*60},-50 {i*60+50},-50 {i*60+50},0"/></g>'
+                    for i, color in enumerate(images))
+    return ('<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" '
+            f'width="{60*len(images)}pt" height="60pt"><g id="graph0" class="graph">{nodes}</g></svg>')
+
+
+def check_optimize():
+    for m, X, y, feature_names, class_names in models():
+        for backend in ['matplotlib', 'svg']:
+            viz = dtreeviz(m, X, y, feature_names, 'target', class_names=class_names,
+                           X=X[3], in_memory=True, backend=backend)
+            svg = optimize_svg(splice_svg_images(fake_layout(viz.images), viz.images))
+            ids = re.findall(r'\bid="([^"]*)"', svg)
+            refs = set(re.findall(r'xlink:href="#([^"]*)"', svg)) | set(re.findall(r'url\(#([^)]*)\)', svg))
+            assert len(ids) == len(set(ids)), "ids defined more than once"
+            assert refs <= set(ids), f"dangling refs {sorted(refs - set(ids))}"
+            assert svg.count('<svg') == len(viz.images) + 1
+
+
+CHECKS = {'samples': check_samples,
+          'scan': check_scan,
+          'summarize': check_summarize,
+          'predict': check_predict,
+          'optimize': check_optimize}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Check animl's fast paths against the simple ones")
+    parser.add_argument('checks', nargs='*', metavar='CHECK', default=list(CHECKS),
+                        help=f"checks to run, from {', '.join(CHECKS)}; default all")
+    args = parser.parse_args()
+    unknown = [name for name in args.checks if name not in CHECKS]
+    if unknown:
+        parser.error(f"unknown checks {', '.join(unknown)}")
+    for name in args.checks:
+        CHECKS[name]()
+        print(f"{name:10s} ok")